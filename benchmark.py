@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Seaward SSS/GAR parsing micro-benchmarks
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: benchmark.py [--sizes 1000,10000] [input1.sss] ...
+#
+# Decoders: every record of the given '.sss' files (or of a synthetic
+# corpus) is decoded repeatedly, first with the generic sdb
+# unpack()/fixup() path, then with the compiled per-type decoders from
+# the dispatch tables, and records/sec is reported for each.  Both must
+# produce identical values.
+#
+# Suite: without input files, synthetic corpora (see corpus.py) of each
+# size are generated and records/sec and MB/sec reported for parsing
+# the SSS stream, deobfuscating the GAR member, inflating it, and for
+# end-to-end extraction and parsing of the '.gar' file.  The same seed
+# is used every time so that runs can be compared.
+
+import StringIO
+import optparse
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import corpus
+import gar
+import portableappliancetest as pat
+
+# Keep repeating until at least this many seconds have been spent
+MINIMUM_DURATION = 1.0
+
+def generic_decode(records):
+    for record in records:
+        view = memoryview(record.payload)
+        for test_type, entry, offset, version in record.spans():
+            entry.test_class().unpack(view, offset)
+
+def compiled_decode(records):
+    for record in records:
+        view = memoryview(record.payload)
+        for test_type, entry, offset, version in record.spans():
+            entry.decode(view, offset)
+
+def check_identical(records):
+    for record in records:
+        view = memoryview(record.payload)
+        for test_type, entry, offset, version in record.spans():
+            generic = entry.test_class().unpack(view, offset)
+            compiled = entry.decode(view, offset)
+            assert generic.data.items() == compiled.data.items()
+
+# Returns how many times per second 'function(*args)' runs
+def measure(function, *args):
+    runs, start = 0, time.time()
+    while True:
+        function(*args)
+        runs += 1
+        elapsed = time.time() - start
+        if elapsed >= MINIMUM_DURATION:
+            return runs / elapsed
+
+def compare_decoders(records):
+    check_identical(records)
+    print 'Decoding %d records' % len(records)
+    before = measure(generic_decode, records) * len(records)
+    after = measure(compiled_decode, records) * len(records)
+    print '%-10s %12.0f records/sec' % ('generic', before)
+    print '%-10s %12.0f records/sec (%.1fx)' % ('compiled', after, after / before)
+
+# == Suite stages ==
+def parse_all(records):
+    for record in records:
+        for subrecord in record.subrecords():
+            pass
+
+def parse_sss(data):
+    parse_all(pat.iter_sss_buffer(data))
+
+def deobfuscate(member, payload):
+    gar.deobfuscate_bytes(gar.XorshiftKeystream(x = member.truncated_timestamp,
+                                                y = member.original_length), payload)
+
+def extract_and_parse(gar_filename):
+    parse_all(pat.open_records(gar_filename))
+
+def report(count, stage, runs_per_second, count_items, size):
+    print '%10d  %-12s %12.0f records/sec %8.2f MB/sec' % \
+        (count, stage, runs_per_second * count_items, runs_per_second * size / 1e6)
+
+def suite(sizes):
+    for count in sizes:
+        data = corpus.sss_stream(count)
+        container = corpus.gar_container(data)
+        member = gar.gar_index(StringIO.StringIO(container))[0]
+        payload = container[member.offset + 16:member.offset + member.compressed_length]
+        pnr = gar.XorshiftKeystream(x = member.truncated_timestamp, y = member.original_length)
+        pnr.keystream(4)
+        zlib_stream = gar.deobfuscate_bytes(pnr, payload)
+
+        report(count, 'parse', measure(parse_sss, data), count, len(data))
+        report(count, 'deobfuscate', measure(deobfuscate, member, payload), count, len(payload))
+        report(count, 'inflate', measure(zlib.decompress, zlib_stream), count, len(data))
+
+        handle, gar_filename = tempfile.mkstemp(suffix='.gar')
+        os.write(handle, container)
+        os.close(handle)
+        try:
+            report(count, 'end-to-end', measure(extract_and_parse, gar_filename), count, len(container))
+        finally:
+            os.unlink(gar_filename)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [input.sss] ...')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='comma separated synthetic corpus sizes, in records (default: %default)')
+    options, args = parser.parse_args()
+
+    if args:
+        records = []
+        for filename in args:
+            records.extend(pat.iter_sss_buffer(pat.map_sss(filename)))
+        if not records:
+            print >>sys.stderr, "no records to decode"
+            sys.exit(1)
+        compare_decoders(records)
+        return
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    compare_decoders(list(pat.iter_sss_buffer(corpus.sss_stream(sizes[0]))))
+    print
+    suite(sizes)
+
+if __name__=='__main__':
+    main()
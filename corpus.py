@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Synthetic Seaward SSS/GAR test corpus generator
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: corpus.py -n 10000 results.sss
+#          corpus.py -n 10000 --photos 3 results.gar
+#
+# Real '.sss' and '.gar' files are scarce (see the notes at the top of
+# portableappliancetest.py and gar.py), so this writes valid streams
+# built from the same record layouts and checksum rules the parser
+# decodes, and wraps them in GAR containers using the same xorshift
+# and qCompress scheme that gar_extract() reverses.  Output is
+# repeatable for a given --seed.
+#
+# == Records ==
+# Each record is a visual test, followed by a selection of electrical
+# tests in either the version 1 or version 2 (0x11/0x12) layouts, an
+# optional user data (free text) sub-record, the software version, an
+# overall pass/fail and the end of record marker.  Field values are
+# drawn at random within what each field can hold: scaled values get a
+# 2-bit exponent and 14-bit mantissa, pass flags follow the result.
+#
+# == Corruption ==
+# A fraction of records can be corrupted by altering one payload byte
+# without updating the checksum, as seen in partial meter downloads.
+
+import optparse
+import random
+import struct
+import sys
+
+import gar
+import portableappliancetest as pat
+
+Sites = ['Head Office', 'Warehouse', 'Workshop', 'Depot North', 'Depot South']
+Locations = ['Kitchen', 'Reception', 'Office 1', 'Office 2', 'Store', 'Canteen']
+Testers = ['PS', 'AB', 'CD', 'EF']
+UserText = ['Cable damaged', 'Plug cracked', 'Fuse incorrect rating', 'Strain relief loose']
+
+# Electrical tests in each layout version, by type code
+ElectricalTests = {1: [0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf8],
+                   2: [0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8]}
+
+def _text(rng, size, choices=None):
+    if choices is None:
+        text = ''.join([rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789') for i in range(size - 1)])
+    else:
+        text = rng.choice(choices)
+    return text[:size - 1]
+
+def _digits(rng, size):
+    return ''.join([rng.choice('0123456789') for i in range(size)])
+
+# Raw (undecoded) values for every field of 'test_class'
+def random_fields(rng, test_class, failed=False):
+    values = []
+    for name, type, size in test_class.fields:
+        if type == str:
+            values.append(_text(rng, size, UserText if test_class is pat.SSSUserDataTest else None))
+        elif name in test_class.flags or name in test_class.nonzero_flags:
+            values.append(0 if failed else 1)
+        elif name in test_class.scaled:
+            values.append(rng.randint(0, 2) << 14 | rng.randint(1, 0x3fff))
+        elif hasattr(test_class, 'mappings'):
+            values.append(rng.choice(sorted(test_class.mappings)))
+        else:
+            values.append(rng.randint(0, (1 << (8 * size)) - 1))
+    return values
+
+def pack_subrecord(test_type, test_class, values):
+    return chr(test_type) + test_class.layout_for('>').struct.pack(*values)
+
+def visual_subrecord(rng, version, failed):
+    test_type = (0x01, 0x11)[version - 1] + (failed and rng.random() < 0.5)
+    values = ['A%07d' % rng.randint(0, 9999999),
+              rng.randint(0, 23), rng.randint(0, 59),
+              rng.randint(1, 28), rng.randint(1, 12), rng.randint(2005, 2014),
+              rng.choice(Sites), rng.choice(Locations), rng.choice(Testers),
+              _digits(rng, 10), _digits(rng, 10)]
+    return pack_subrecord(test_type, pat.SSSVisualTest, values), test_type in pat.FailTestCodes
+
+# Prefix a payload with its six-byte record header
+def sss_record(payload):
+    return struct.pack('>HHH', len(payload), 0, pat.sss_checksum(payload)) + payload
+
+def random_payload(rng, version=1, failed=False, user_data=False):
+    Tests = pat.DispatchVersion2 if version == 2 else pat.DispatchVersion1
+    visual, visual_failed = visual_subrecord(rng, version, failed)
+    parts = [visual]
+    if version == 1 and rng.random() < 0.5:
+        parts.append(pack_subrecord(0xe0, pat.SSSUserDataMappingTest,
+                                    random_fields(rng, pat.SSSUserDataMappingTest)))
+        parts.append(pack_subrecord(0xe1, pat.SSSRetestTest, [0, 1, rng.choice([3, 6, 12, 24])]))
+    tests = ElectricalTests[version]
+    for test_type in sorted(rng.sample(tests, rng.randint(0, len(tests)))):
+        test_class = Tests[test_type].test_class
+        parts.append(pack_subrecord(test_type, test_class, random_fields(rng, test_class, failed)))
+    if version == 2 and rng.random() < 0.3:
+        parts.append(chr(0xf9))
+    if user_data:
+        parts.append(pack_subrecord(0xfb, pat.SSSUserDataTest, random_fields(rng, pat.SSSUserDataTest)))
+    parts.append(pack_subrecord(0xfe, pat.SSSSoftwareVersionTest,
+                                ['%02dA-%04d' % (rng.randint(10, 99), rng.randint(0, 9999)), 1, 2, rng.randint(0, 9)]))
+    parts.append(chr(0xf1 if failed or visual_failed else 0xf0))
+    parts.append(chr(0xff))
+    return ''.join(parts)
+
+# A complete SSS stream of 'count' records, mixing versions, fails,
+# user data and (optionally) corrupt records in the given proportions.
+def sss_stream(count, seed=0, v2=0.5, fails=0.1, user_data=0.2, corrupt=0.0):
+    rng = random.Random(seed)
+    records = []
+    for i in xrange(count):
+        failed = rng.random() < fails
+        payload = random_payload(rng, 2 if rng.random() < v2 else 1, failed,
+                                 failed or rng.random() < user_data)
+        record = sss_record(payload)
+        if rng.random() < corrupt:
+            position = rng.randint(6, len(record) - 1)
+            record = record[:position] + chr((ord(record[position]) + 1) & 0xff) + record[position + 1:]
+        records.append(record)
+    return ''.join(records)
+
+# A GAR container holding the results (as 'TestResults.sss') and any
+# number of (incompressible, JPEG-sized) photo attachments.
+def gar_container(results, photos=0, photo_size=20000, seed=0):
+    rng = random.Random(seed)
+    timestamp = rng.randint(0, 0x7fffffff)
+    members = [gar.gar_member_encode('TestResults.sss', results, timestamp)]
+    for i in xrange(photos):
+        timestamp += rng.randint(1, 100)
+        photo = ''.join([chr(rng.getrandbits(8)) for j in xrange(photo_size)])
+        members.append(gar.gar_member_encode('Photo %d.jpg' % (i + 1), photo, timestamp))
+    return gar.GAR_HEADER + ''.join(members)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <output.sss|output.gar>')
+    parser.add_option('-n', '--records', type='int', default=1000, help='number of records (default: %default)')
+    parser.add_option('--seed', type='int', default=0, help='random seed (default: %default)')
+    parser.add_option('--v2', type='float', default=0.5, help='fraction of version 2 records (default: %default)')
+    parser.add_option('--fails', type='float', default=0.1, help='fraction of failed records (default: %default)')
+    parser.add_option('--user-data', type='float', default=0.2, help='fraction with user data text (default: %default)')
+    parser.add_option('--corrupt', type='float', default=0.0, help='fraction of corrupt records (default: %default)')
+    parser.add_option('--photos', type='int', default=0, help='photo attachments in a .gar (default: %default)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+
+    data = sss_stream(options.records, options.seed, options.v2, options.fails,
+                      options.user_data, options.corrupt)
+    if args[0].lower().endswith('.gar'):
+        data = gar_container(data, options.photos, seed=options.seed)
+    f = open(args[0], 'wb')
+    f.write(data)
+    f.close()
+    print 'Wrote %d records (%d bytes) to "%s"' % (options.records, len(data), args[0])
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Seaward SSS/GAR drop-folder ingestion service
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: dropfolder.py --socket /tmp/pat.sock --output results/ incoming/
+#          dropfolder.py upload /tmp/pat.sock input1.gar [input2.sss] ...
+#
+# Rather than waiting for the next cron run, this keeps running and
+# picks up each '.sss' or '.gar' file as soon as it lands in the drop
+# folder, writing its records as JSON Lines to '<output>/<name>.jsonl'
+# (corrupt ranges are skipped, as with --recover) and printing a
+# one-line summary in the same form as batch mode.
+#
+# == Watching ==
+# The folder is polled every --interval seconds.  A file is only taken
+# once its size and modification time are unchanged between two polls,
+# so files still being copied in are left alone; it is taken again if
+# it later changes.  Files whose '.jsonl' output is already newer are
+# skipped, so restarting the service does not redo everything.
+#
+# == Uploads ==
+# With --socket, files can also be pushed over a local Unix socket:
+# send the filename and a newline, then the contents, and shut down
+# the sending side; the reply is 'OK <name>' or 'ERROR <reason>'.  The
+# upload is written into the drop folder (under a hidden temporary
+# name, then renamed) and queued straight away.
+#
+# == Workers ==
+# Parsing, deobfuscation and inflating run in a multiprocessing pool of
+# --jobs processes, with at most two files in flight per worker.  The
+# rest wait in a queue; once that holds --queue files, new uploads are
+# not accepted (they wait in the socket's listen backlog) until it
+# drains.  Everything else happens in a single select() loop.
+
+import collections
+import errno
+import itertools
+import multiprocessing
+import optparse
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import gar
+import portableappliancetest as pat
+
+# Bytes read from an upload connection at a time
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def _is_input(name):
+    return not name.startswith('.') and name.lower().endswith(('.sss', '.gar'))
+
+def output_filename(output_directory, filename):
+    return os.path.join(output_directory, os.path.basename(filename) + '.jsonl')
+
+# Runs in a worker process: export every record of 'filename' as JSON
+# Lines (written under a temporary name, then renamed into place) and
+# return its SSSFileSummary.
+def ingest_file(args):
+    filename, output_directory = args
+    skipped = []
+    counts = [0, 0]
+    message = None
+
+    def counted(records):
+        for record in records:
+            counts[0] += 1
+            counts[1] += record.failed()
+            yield record
+
+    target = output_filename(output_directory, filename)
+    partial = os.path.join(output_directory, '.' + os.path.basename(target) + '.partial')
+    try:
+        output = open(partial, 'wb', pat.EXPORT_BUFFER_SIZE)
+        try:
+            records = pat.open_records(filename, lambda start, end, error: skipped.append(error))
+            pat.JSONLinesExporter(output).write(counted(records), filename)
+        finally:
+            output.close()
+        os.rename(partial, target)
+    except Exception, e:
+        message = '%s: %s' % (e.__class__.__name__, e)
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+    records, fails = counts
+    errors = len(skipped) + (message is not None)
+    return pat.SSSFileSummary(filename, records, records - fails, fails, errors, message)
+
+class Upload(object):
+    """One upload connection: the filename line, then the contents
+    streamed to a temporary file in the drop folder."""
+
+    def __init__(self, connection, directory):
+        self.connection = connection
+        self.directory = directory
+        self.header = ''
+        self.name = None
+        self.output = None
+        self.temporary = None
+        self.error = None
+
+    # Returns False once the sender has finished
+    def receive(self):
+        data = self.connection.recv(UPLOAD_CHUNK_SIZE)
+        if not data:
+            return False
+        if self.error is not None:
+            # Rejected; drain the rest so the reply is not lost to a reset
+            return True
+        if self.name is None:
+            self.header += data
+            if '\n' not in self.header:
+                if len(self.header) > 4096:
+                    raise ValueError('no filename')
+                return True
+            name, data = self.header.split('\n', 1)
+            self.name = gar.clean_filename(os.path.basename(name.strip()))
+            if not _is_input(self.name):
+                self.error = 'not an .sss or .gar filename: %r' % name
+                return True
+            # Each connection gets its own hidden file, even for the same name
+            handle, self.temporary = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.upload')
+            self.output = os.fdopen(handle, 'wb')
+        self.output.write(data)
+        return True
+
+    # Move the completed upload into place, returning its filename.  An
+    # existing file, or one 'taken' (eg. still queued), is never replaced;
+    # a numbered suffix is added instead.  Linking (rather than renaming)
+    # fails if the name has been taken meanwhile.
+    def finish(self, taken=lambda filename: False):
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.name is None:
+            raise ValueError('no filename')
+        self.output.close()
+        stem, extension = os.path.splitext(self.name)
+        for i in itertools.count():
+            name = self.name if i == 0 else '%s-%d%s' % (stem, i, extension)
+            filename = os.path.join(self.directory, name)
+            if taken(filename):
+                continue
+            try:
+                os.link(self.temporary, filename)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            break
+        os.unlink(self.temporary)
+        self.temporary = None
+        return filename
+
+    def reply(self, message):
+        try:
+            self.connection.setblocking(1)
+            self.connection.sendall(message + '\n')
+        except socket.error:
+            pass
+        self.connection.close()
+
+    def abort(self, message):
+        if self.output is not None:
+            self.output.close()
+        if self.temporary is not None:
+            try:
+                os.unlink(self.temporary)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.reply('ERROR %s' % message)
+
+class DropFolderService(object):
+    """Watches 'directory' (and optionally a Unix socket) and feeds new
+    files through a bounded pool of worker processes."""
+
+    def __init__(self, directory, output_directory, socket_filename=None,
+                 processes=None, interval=2.0, max_queued=100, report=None):
+        self.directory = directory
+        self.output_directory = output_directory
+        self.interval = interval
+        self.max_queued = max_queued
+        self.report = report or print_summary
+        self.pool = multiprocessing.Pool(processes)
+        self.max_pending = 2 * (processes or multiprocessing.cpu_count())
+
+        self.seen = {}        # filename -> (size, mtime) at the last poll
+        self.done = {}        # filename -> (size, mtime) when it was queued
+        self.queue = collections.deque()
+        self.pending = []     # (filename, AsyncResult)
+        self.uploads = {}     # socket -> Upload
+        self.listener = None
+        self.socket_filename = socket_filename
+        if socket_filename is not None:
+            if os.path.exists(socket_filename):
+                os.unlink(socket_filename)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(socket_filename)
+            self.listener.listen(16)
+            self.listener.setblocking(0)
+
+    def enqueue(self, filename, signature):
+        self.done[filename] = signature
+        if filename not in self.queue:
+            self.queue.append(filename)
+
+    # Queued or being worked on
+    def taken(self, filename):
+        return filename in self.queue or filename in [f for f, result in self.pending]
+
+    def _up_to_date(self, filename, mtime):
+        try:
+            return os.stat(output_filename(self.output_directory, filename)).st_mtime >= mtime
+        except OSError:
+            return False
+
+    # Queue files whose size and mtime have stopped changing
+    def poll(self):
+        seen = {}
+        for name in sorted(os.listdir(self.directory)):
+            filename = os.path.join(self.directory, name)
+            if not _is_input(name):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            signature = (st.st_size, st.st_mtime)
+            seen[filename] = signature
+            if self.seen.get(filename) != signature or self.done.get(filename) == signature:
+                continue
+            if filename not in self.done and self._up_to_date(filename, st.st_mtime):
+                self.done[filename] = signature
+                continue
+            self.enqueue(filename, signature)
+        self.seen = seen
+
+    def submit(self):
+        while self.queue and len(self.pending) < self.max_pending:
+            filename = self.queue.popleft()
+            result = self.pool.apply_async(ingest_file, [(filename, self.output_directory)])
+            self.pending.append((filename, result))
+
+    def collect(self):
+        still_pending = []
+        for filename, result in self.pending:
+            if result.ready():
+                self.report(result.get())
+            else:
+                still_pending.append((filename, result))
+        self.pending = still_pending
+
+    def accept(self):
+        try:
+            connection, address = self.listener.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        connection.setblocking(0)
+        self.uploads[connection] = Upload(connection, self.directory)
+
+    def receive(self, connection):
+        upload = self.uploads[connection]
+        try:
+            if upload.receive():
+                return
+            filename = upload.finish(self.taken)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            del self.uploads[connection]
+            upload.abort(str(e))
+            return
+        except (ValueError, IOError, OSError), e:
+            del self.uploads[connection]
+            upload.abort(str(e))
+            return
+        del self.uploads[connection]
+        st = os.stat(filename)
+        self.enqueue(filename, (st.st_size, st.st_mtime))
+        upload.reply('OK %s' % os.path.basename(filename))
+
+    def run_once(self, timeout):
+        readable = self.uploads.keys()
+        # Backpressure: stop accepting uploads while the queue is full
+        if self.listener is not None and len(self.queue) < self.max_queued:
+            readable.append(self.listener)
+        if readable:
+            ready, writable, failed = select.select(readable, [], [], timeout)
+        else:
+            ready = []
+            time.sleep(timeout)
+        for s in ready:
+            if s is self.listener:
+                self.accept()
+            else:
+                self.receive(s)
+        self.collect()
+        self.submit()
+
+    def run(self):
+        next_poll = 0
+        try:
+            while True:
+                now = time.time()
+                if now >= next_poll:
+                    self.poll()
+                    self.submit()
+                    next_poll = now + self.interval
+                # Check back often while work is in flight
+                timeout = next_poll - now
+                if self.pending:
+                    timeout = min(timeout, 0.1)
+                self.run_once(max(timeout, 0))
+        finally:
+            self.close()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            os.unlink(self.socket_filename)
+        self.pool.terminate()
+
+def print_summary(summary):
+    print 'File {filename:%r, records:%d, passes:%d, fails:%d, errors:%d}' % summary[:5]
+    if summary.message is not None:
+        print 'End File {Error:"%s"}' % summary.message
+    sys.stdout.flush()
+
+# Client side of the upload endpoint; returns the service's reply
+def upload(socket_filename, filename):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_filename)
+    s.sendall(os.path.basename(filename) + '\n')
+    f = open(filename, 'rb')
+    for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), ''):
+        s.sendall(chunk)
+    f.close()
+    s.shutdown(socket.SHUT_WR)
+    reply = ''.join(iter(lambda: s.recv(4096), '')).strip()
+    s.close()
+    return reply
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <drop directory>\n'
+                                         '       %prog upload <socket> <input.sss|input.gar> ...')
+    parser.add_option('-o', '--output', metavar='DIR',
+                      help='directory for the .jsonl results (default: the drop directory)')
+    parser.add_option('--socket', metavar='PATH', help='also accept uploads on this Unix socket')
+    parser.add_option('--interval', type='float', default=2.0,
+                      help='seconds between polls of the drop directory (default: %default)')
+    parser.add_option('-j', '--jobs', type='int', default=None, metavar='N',
+                      help='number of worker processes (default: one per CPU)')
+    parser.add_option('--queue', type='int', default=100, metavar='N',
+                      help='stop accepting uploads while N files are waiting (default: %default)')
+    options, args = parser.parse_args()
+
+    if args and args[0] == 'upload':
+        if len(args) < 3:
+            parser.print_usage(sys.stderr)
+            sys.exit(2)
+        for filename in args[2:]:
+            print '%s: %s' % (filename, upload(args[1], filename))
+        return
+
+    if len(args) != 1:
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+    service = DropFolderService(args[0], options.output or args[0], options.socket,
+                                options.jobs, options.interval, options.queue)
+    # Stopping the service (eg. SIGTERM) still removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=='__main__':
+    main()
@@ -5,6 +5,7 @@
 # electrical safety and interoperability.
 #
 # Example: gar.py <input1.gar> [input2.gar] ...
+#          gar.py --create <output.gar> TestResults.sss [photo1.jpg] ...
 #
 # This would extract the results to 'input1_TestResults.sss', and any
 # other JPEG attachments to 'input1_...jpg'.  Note that the JPEGs are
@@ -74,10 +75,19 @@
 # Aside from failing to decode/validate, the zlib checksum provides
 # the only defacto integrity checking in the GAR file-format.
 
+import binascii
+import collections
+import itertools
+import mmap
+import multiprocessing
+import optparse
+import os
 import struct
-import sys
+import time
 import zlib
 
+import instrumentation
+
 # Marsaglia xorshift, using default parameters
 # https://en.wikipedia.org/wiki/Xorshift
 # http://stackoverflow.com/questions/4508043/on-xorshift-random-number-generator-algorithm
@@ -94,17 +104,292 @@ def marsaglia_xorshift_128(x = 123456789, y = 362436069, z = 521288629, w = 8867
 def deobfuscate_string(pnr, obfuscated, operation=int.__sub__):
     return ''.join([chr((operation(ord(c), pnr.next())) & 0xff) for c in obfuscated])
 
+# The generator above costs a Python-level resume, an ord() and a chr()
+# per byte.  For whole members it is considerably quicker to hold the
+# 128-bit state in locals, produce the bottom 8-bits for a run of
+# bytes into one contiguous bytearray, and keep the state around for
+# the next call.  The output is identical to marsaglia_xorshift_128().
+class XorshiftKeystream(object):
+    def __init__(self, x = 123456789, y = 362436069, z = 521288629, w = 88675123):
+        self.state = (x, y, z, w)
+
+    def keystream(self, length):
+        x, y, z, w = self.state
+        out = bytearray(length)
+        for i in xrange(length):
+            t = (x ^ (x << 11)) & 0xffffffff
+            x, y, z = y, z, w
+            w = (w ^ (w >> 19) ^ (t ^ (t >> 8)))
+            out[i] = w & 0xff
+        self.state = (x, y, z, w)
+        return out
+
+    def jump(self, steps):
+        self.state = xorshift_jump(self.state, steps)
+        return self
+
+# Every part of the xorshift step (shifts, masking and XOR) is linear
+# over GF(2), so the 128-bit state after N steps is the state times
+# a 128x128 bit-matrix raised to the Nth power.  Matrices are held as
+# a list of 128 column bitmasks (the image of each single state bit),
+# with state packed as x | y<<32 | z<<64 | w<<96.  The squarings
+# M^(2^k) are computed on demand and kept for reuse.
+def _xorshift_pack(state):
+    x, y, z, w = state
+    return x | (y << 32) | (z << 64) | (w << 96)
+
+def _xorshift_unpack(packed):
+    return tuple([(packed >> shift) & 0xffffffff for shift in (0, 32, 64, 96)])
+
+def _gf2_apply(columns, vector):
+    result, i = 0, 0
+    while vector:
+        if vector & 1:
+            result ^= columns[i]
+        vector >>= 1
+        i += 1
+    return result
+
+def _xorshift_step_matrix():
+    columns = []
+    for bit in xrange(128):
+        ks = XorshiftKeystream(*_xorshift_unpack(1 << bit))
+        ks.keystream(1)
+        columns.append(_xorshift_pack(ks.state))
+    return columns
+
+_xorshift_jump_matrices = []
+
+def xorshift_jump(state, steps):
+    packed = _xorshift_pack(state)
+    k = 0
+    while steps:
+        if len(_xorshift_jump_matrices) <= k:
+            if not _xorshift_jump_matrices:
+                _xorshift_jump_matrices.append(_xorshift_step_matrix())
+            else:
+                m = _xorshift_jump_matrices[-1]
+                _xorshift_jump_matrices.append([_gf2_apply(m, c) for c in m])
+        if steps & 1:
+            packed = _gf2_apply(_xorshift_jump_matrices[k], packed)
+        steps >>= 1
+        k += 1
+    return _xorshift_unpack(packed)
+
+# Bytewise ADD/SUB (modulo 256, no carry between bytes) of a whole
+# buffer in one pass: both buffers are turned into a single big
+# integer, and the high bit of each byte is masked off so that
+# carries/borrows can never cross into the neighbouring byte (SWAR).
+def _bytewise(data, keystream, operation):
+    length = len(data)
+    if not length:
+        return ''
+    high = int('80' * length, 16)
+    low = high ^ int('ff' * length, 16)
+    a = int(binascii.hexlify(data), 16)
+    b = int(binascii.hexlify(keystream), 16)
+    if operation == int.__sub__:
+        r = ((a | high) - (b & low)) ^ ((a ^ b ^ high) & high)
+    else:
+        r = ((a & low) + (b & low)) ^ ((a ^ b) & high)
+    return binascii.unhexlify('%0*x' % (2 * length, r))
+
+# Bulk equivalent of deobfuscate_string(), taking an XorshiftKeystream
+# and returning a str; the keystream state is advanced by len(obfuscated).
+def deobfuscate_bytes(keystream, obfuscated, operation=int.__sub__):
+    ks = keystream.keystream(len(obfuscated))
+    if operation in (int.__sub__, int.__add__):
+        return _bytewise(obfuscated, ks, operation)
+    return str(bytearray([operation(c, k) & 0xff for c, k in zip(bytearray(obfuscated), ks)]))
+
+# Large members (full-size photos) can be split into chunks, with
+# each chunk's keystream started by jumping ahead from the member's
+# starting state; a multiprocessing pool then deobfuscates the chunks
+# and they are handed back in their original order.
+PARALLEL_CHUNK_SIZE = 256 * 1024
+
+def _deobfuscate_chunk(args):
+    state, obfuscated = args
+    return deobfuscate_bytes(XorshiftKeystream(*state), obfuscated)
+
+def deobfuscate_parallel(pool, keystream, obfuscated, chunk_size=PARALLEL_CHUNK_SIZE):
+    jobs = []
+    for offset in xrange(0, len(obfuscated), chunk_size):
+        jobs.append((xorshift_jump(keystream.state, offset), obfuscated[offset:offset + chunk_size]))
+    keystream.jump(len(obfuscated))
+    return pool.imap(_deobfuscate_chunk, jobs)
+
 # Remove spaces and directory slashes from a string (filename).
 # This is useful for saving a file in the current directory, rather
 # than needing to recreate the structure of the container.
 def clean_filename(unsafe_filename):
     return unsafe_filename.replace('/','_').replace(' ','_').replace('\\','_')
 
-# The main parse and extract from Seaward '.GAR' container starts here
-def gar_extract(container_filename):
+# Decode a single member whose 'compressed_length' bytes start at the
+# current position of 'container', writing the original contents to
+# 'output' (anything with a .write() method).  By default the member
+# is read and decoded in one piece; given a 'chunk_size' it is instead
+# read, deobfuscated (carrying the xorshift state across) and inflated
+# one chunk at a time, so memory use stays flat however large the
+# member is; 'pool' is then unused, as streaming is serial.  Returns
+# the original length once it has been checked.
+def gar_member_extract(container, compressed_length, output, pool=None, chunk_size=None):
+    read, deobfuscate, parallel = container.read, deobfuscate_bytes, deobfuscate_parallel
+    inflater = zlib.decompressobj()
+    decompress, flush = inflater.decompress, inflater.flush
 
-    # Try to read the filename we've been asked to parse
-    container = open(container_filename, 'rb')
+    # With instrumentation on, each stage is timed
+    stats = instrumentation.active
+    if stats is not None:
+        read = stats.timed('gar.read', read)
+        deobfuscate = stats.timed('gar.deobfuscate', deobfuscate)
+        # The pool hands chunks back lazily, so the wait for each one is
+        # timed as well as setting the jobs up
+        timed_parallel = stats.timed('gar.deobfuscate', parallel)
+        parallel = lambda *args: stats.timed_iter('gar.deobfuscate', timed_parallel(*args))
+        decompress = stats.timed('gar.inflate', decompress)
+        flush = stats.timed('gar.inflate', flush)
+
+    header = read(16)
+    header_length, mangling_method, truncated_timestamp, original_length = struct.unpack('>HHLL', header[:12])
+    assert header_length == 12 and mangling_method == 1
+
+    # The file contents are obfuscated with a Marsaglia xorshift PNR
+    pnr = XorshiftKeystream(x = truncated_timestamp, y = original_length)
+
+    # There is also a (second) obfuscated copy of the original file length
+    # and then the (compressed) file contents.
+    qcompress_prefix = deobfuscate(pnr, header[12:16])
+    expected_length, = struct.unpack(">L", qcompress_prefix)
+    assert original_length == expected_length
+
+    # We can check the lengths match up, and if so try to uncompress with zlib
+    remaining = compressed_length - 16
+    written = 0
+    if chunk_size is None:
+        contents = read(remaining)
+        if pool is not None and remaining >= 2 * PARALLEL_CHUNK_SIZE:
+            zlib_chunks = parallel(pool, pnr, contents)
+        else:
+            zlib_chunks = [deobfuscate(pnr, contents)]
+        original = ''.join([decompress(c) for c in zlib_chunks]) + flush()
+        output.write(original)
+        written = len(original)
+    else:
+        while remaining > 0:
+            contents = read(min(chunk_size, remaining))
+            if not contents:
+                break
+            remaining -= len(contents)
+            zlib_chunk = deobfuscate(pnr, contents)
+            while zlib_chunk:
+                original = decompress(zlib_chunk, chunk_size)
+                output.write(original)
+                written += len(original)
+                zlib_chunk = inflater.unconsumed_tail
+        original = flush()
+        output.write(original)
+        written += len(original)
+
+    assert original_length == expected_length == written
+    if stats is not None:
+        stats.count('gar.members')
+        stats.count('gar.compressed_bytes', compressed_length)
+        stats.count('gar.original_bytes', original_length)
+    return original_length
+
+# The inverse of gar_member_extract(): build a complete archive record
+# (filename and payload lengths, header, then the qCompress-style length
+# prefix and zlib stream, obfuscated by adding the xorshift keystream).
+def gar_member_encode(filename, contents, truncated_timestamp, level=6):
+    compressed = struct.pack('>L', len(contents)) + zlib.compress(contents, level)
+    pnr = XorshiftKeystream(x = truncated_timestamp, y = len(contents))
+    payload = struct.pack('>HHLL', 12, 1, truncated_timestamp, len(contents)) + \
+        deobfuscate_bytes(pnr, compressed, int.__add__)
+    return struct.pack('>L', len(filename)) + filename + struct.pack('>L', len(payload)) + payload
+
+# Container file-header: magic 0xcabcab and version 1
+GAR_HEADER = struct.pack('>L', 0xcabcab << 8 | 1)
+
+# == Writing ==
+# Each member is compressed and obfuscated independently, so given a
+# multiprocessing pool the members are encoded in parallel (workers
+# read their own input files, only the much smaller encoded records
+# come back) and written in their original order as they complete.
+def _encode_file(args):
+    path, name, truncated_timestamp, level = args
+    f = open(path, 'rb')
+    contents = f.read()
+    f.close()
+    return gar_member_encode(name, contents, truncated_timestamp, level)
+
+# Timestamps for 'count' members: monotonically increasing from 'start'
+# (by default the current time), truncated to 32 bits.
+def gar_timestamps(count, start=None):
+    if start is None:
+        start = int(time.time())
+    return [(start + i) & 0xffffffff for i in xrange(count)]
+
+# Write a container holding 'filenames' (stored under their basenames)
+# to 'output'; returns the list of member names written.
+def gar_write(output, filenames, pool=None, level=6, start=None):
+    names = [os.path.basename(filename) for filename in filenames]
+    jobs = zip(filenames, names, gar_timestamps(len(filenames), start), [level] * len(filenames))
+    output.write(GAR_HEADER)
+    encoded = pool.imap(_encode_file, jobs) if pool is not None else itertools.imap(_encode_file, jobs)
+    for member in encoded:
+        output.write(member)
+    return names
+
+def gar_create(container_filename, filenames, pool=None, level=6, start=None):
+    f = open(container_filename, 'wb')
+    try:
+        return gar_write(f, filenames, pool, level, start)
+    finally:
+        f.close()
+
+# Round-trip check: decode every member of a freshly written container
+# and compare it with the file it was built from.
+def gar_verify(container_filename, filenames):
+    container = gar_open(container_filename)
+    members = gar_index(container)
+    if [m.filename for m in members] != [os.path.basename(f) for f in filenames]:
+        raise ValueError('members differ: %r' % [m.filename for m in members])
+    for member, filename in zip(members, filenames):
+        container.seek(member.offset)
+        output = MemberBuffer()
+        gar_member_extract(container, member.compressed_length, output)
+        f = open(filename, 'rb')
+        contents = f.read()
+        f.close()
+        if output.getvalue() != contents:
+            raise ValueError('member "%s" differs' % member.filename)
+    return len(members)
+
+# Members are read this many bytes at a time when streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Open a container for reading, memory-mapped where possible so that
+# indexing and seeking between members need no read() calls at all.
+# The returned object supports read()/seek()/tell() either way.
+def gar_open(container_filename):
+    f = open(container_filename, 'rb')
+    try:
+        container = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        return f
+    f.close()
+    return container
+
+# One entry per file stored within a container; 'offset' is where its
+# (obfuscated) record starts, ready for gar_member_extract().
+GARMember = collections.namedtuple('GARMember',
+    'filename offset compressed_length truncated_timestamp original_length')
+
+# Walk just the record headers, seeking past each payload without
+# decoding it, and return the list of GARMember entries.
+def gar_index(container):
+    container.seek(0)
 
     # The GAR container's magic number is 0xcabcab
     container_header = struct.unpack('>L', container.read(4))[0]
@@ -112,6 +397,7 @@ def gar_extract(container_filename):
     assert container_magic == 0xcabcab and container_version == 1
 
     # The container has no end-of-file marker, it ends when there are no more records
+    members = []
     while True:
         s = container.read(4)
         if len(s) < 4:
@@ -123,22 +409,47 @@ def gar_extract(container_filename):
 
         # Followed by a file contents, variable length depending on compression
         compressed_length, = struct.unpack('>L', container.read(4))
-        contents = container.read(compressed_length)
-        header_length, mangling_method, truncated_timestamp, original_length = struct.unpack('>HHLL', contents[:12])
-        assert header_length == 12 and mangling_method == 1
+        offset = container.tell()
+        header_length, mangling_method, truncated_timestamp, original_length = struct.unpack('>HHLL', container.read(12))
+        members.append(GARMember(filename, offset, compressed_length, truncated_timestamp, original_length))
+        container.seek(offset + compressed_length)
+    return members
+
+# Extract a single named member (eg. 'TestResults.sss') to 'output'
+# without decoding any of the other members.
+def gar_extract_member(container_filename, name, output, pool=None, chunk_size=None):
+    container = gar_open(container_filename)
+    for member in gar_index(container):
+        if member.filename == name:
+            container.seek(member.offset)
+            return gar_member_extract(container, member.compressed_length, output, pool, chunk_size)
+    raise KeyError(name)
 
-        # The file contents are obfuscated with a Marsaglia xorshift PNR
-        pnr = marsaglia_xorshift_128(x = truncated_timestamp, y = original_length)
+# Collects member contents in memory; a single write (the default
+# non-streaming case) is handed back by getvalue() without a copy.
+class MemberBuffer(list):
+    write = list.append
+    def getvalue(self):
+        return ''.join(self)
 
-        # There is also a (second) obfuscated copy of the original file length
-        # and then the (compressed) file contents.
-        qcompress_prefix = deobfuscate_string(pnr, contents[12:16])
-        zlib_stream = deobfuscate_string(pnr, contents[16:])
+# Return the contents of a single named member as a string, decoded
+# entirely in memory with no temporary file.
+def gar_read_member(container_filename, name, pool=None):
+    output = MemberBuffer()
+    gar_extract_member(container_filename, name, output, pool)
+    return output.getvalue()
 
-        # We can check the lengths match up, and if so try to uncompress with zlib
-        expected_length, = struct.unpack(">L", qcompress_prefix)
-        assert original_length == expected_length
-        original = zlib.decompress(zlib_stream)
+# The main parse and extract from Seaward '.GAR' container starts here.
+# If 'names' is given, only the members with those filenames are extracted.
+def gar_extract(container_filename, pool=None, chunk_size=None, names=None):
+
+    # Try to read the filename we've been asked to parse
+    container = gar_open(container_filename)
+
+    for member in gar_index(container):
+        filename, compressed_length = member.filename, member.compressed_length
+        if names is not None and filename not in names:
+            continue
 
         # And try to ensure that filename can be saved to the local directory
         target_filename = filename
@@ -147,23 +458,73 @@ def gar_extract(container_filename):
                 target_filename = container_filename[:-4] + '_' + filename
         safe_filename = clean_filename(target_filename)
 
-        # Assuming it all went well we can inform the user where their file will be saved
-        assert original_length == expected_length == len(original)
+        # Then write out the original uncompressed file to its appropriate name
+        container.seek(member.offset)
+        f = open(safe_filename + '', 'wb')
+        original_length = gar_member_extract(container, compressed_length, f, pool, chunk_size)
+        f.close()
+
+        # Assuming it all went well we can inform the user where their file was saved
         print 'Saving "%s" (%2.0f%%) to "%s"' % \
             (filename,
-             100.0 * float(compressed_length) / (original_length),
+             100.0 * float(compressed_length) / original_length if original_length else 100.0,
              safe_filename)
 
-        # And then write out the original uncompressed file to its appropriate name
-        f = open(safe_filename + '', 'wb')
-        f.write(original)
-        f.close()
+# List the members of a container, without decoding any of them
+def gar_list(container_filename):
+    for member in gar_index(gar_open(container_filename)):
+        print '%10d %10d %10d  %s' % \
+            (member.original_length,
+             member.compressed_length,
+             member.truncated_timestamp,
+             member.filename)
 
 # Step though, allowing multiple '.gar' filenames to be passed at once (handy for testing)
 def main():
-    for gar in sys.argv[1:]:
+    parser = optparse.OptionParser(usage='%prog [options] <input1.gar> [input2.gar] ...\n'
+                                         '       %prog [options] --create <output.gar> <file1> [file2] ...')
+    parser.add_option('--stream', action='store_true', default=False,
+                      help='extract in fixed-size chunks, using bounded memory (on a single core)')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      help='list the contents of each container instead of extracting')
+    parser.add_option('-m', '--member', action='append', dest='members', metavar='NAME',
+                      help='only extract the named member (may be repeated)')
+    parser.add_option('-c', '--create', metavar='OUTPUT',
+                      help='build the container OUTPUT from the given files instead of extracting')
+    parser.add_option('--verify', action='store_true', default=False,
+                      help='with --create, decode the new container and check it against the files')
+    parser.add_option('--stats', metavar='FILE',
+                      help='write per-stage counters and timings as JSON to FILE (- for stderr) at exit')
+    options, args = parser.parse_args()
+    if options.stats:
+        instrumentation.enable(options.stats)
+
+    if options.list:
+        for gar in args:
+            print 'Listing CAB/GAR filename "%s"' % gar
+            gar_list(gar)
+        return
+
+    if options.create:
+        pool = multiprocessing.Pool()
+        print 'Creating CAB/GAR filename "%s"' % options.create
+        for name in gar_create(options.create, args, pool):
+            print 'Adding "%s"' % name
+        pool.close()
+        if options.verify:
+            print 'Verified %d members' % gar_verify(options.create, args)
+        return
+
+    # Streaming deobfuscates chunk by chunk as it reads, so has no use
+    # for a pool of workers
+    pool, chunk_size = None, STREAM_CHUNK_SIZE
+    if not options.stream:
+        pool, chunk_size = multiprocessing.Pool(), None
+    for gar in args:
         print 'Trying CAB/GAR filename "%s"' % gar
-        gar_extract(gar)
+        gar_extract(gar, pool, chunk_size, options.members)
+    if pool is not None:
+        pool.close()
 
 if __name__=='__main__':
     main()
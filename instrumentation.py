@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Per-stage counters and timings for SSS parsing and GAR extraction
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: portableappliancetest.py --stats stats.json <input1.sss> ...
+#          gar.py --stats - <input1.gar> ...
+#
+# Off by default.  Once enable()d, the parsers pick up the active
+# Stats when they start on a file or member, and swap in timed
+# versions of their read, checksum, deobfuscate, inflate and decode
+# steps; when it is off they run unchanged, with nothing wrapped and
+# at most a single 'is None' test per sub-record.
+#
+# == Names ==
+# sss.read, sss.checksum: reading records from a file handle, and
+#   building each SSSRecord (where the checksum is summed and checked)
+# sss.records, sss.bytes, sss.checksum_failures: records seen
+# sss.decode.XX, sss.subrecords.XX: decoding sub-records by type code
+# gar.read, gar.deobfuscate, gar.inflate: the stages of each member
+# gar.members, gar.compressed_bytes, gar.original_bytes: members seen
+#
+# Timings are cumulative seconds.  Note that worker processes keep
+# their own counters, which are not gathered back, so --stats is
+# refused together with --batch.
+
+import atexit
+import collections
+import json
+import sys
+import time
+
+class Stats(object):
+    """Named counters and cumulative timings."""
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.timings = collections.defaultdict(float)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def call(self, name, function, *args):
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.timings[name] += time.time() - start
+
+    # Wrap 'function' so that every call is timed under 'name'
+    def timed(self, name, function):
+        timings, clock = self.timings, time.time
+        def timed_function(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                timings[name] += clock() - start
+        return timed_function
+
+    # Yield the items of 'iterable', timing under 'name' how long each
+    # one takes to arrive
+    def timed_iter(self, name, iterable):
+        timings, clock = self.timings, time.time
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timings[name] += clock() - start
+            yield item
+
+    def as_dict(self):
+        ratios = {}
+        if self.counters.get('gar.original_bytes'):
+            ratios['gar.compression'] = float(self.counters['gar.compressed_bytes']) / \
+                self.counters['gar.original_bytes']
+        return {'counters': dict(self.counters),
+                'timings': dict(self.timings),
+                'ratios': ratios}
+
+    def dump(self, output):
+        json.dump(self.as_dict(), output, indent=1, sort_keys=True)
+        output.write('\n')
+
+# The Stats being collected into, or None when instrumentation is off
+active = None
+
+# Start collecting.  At exit the results are handed to 'callback' (as
+# the as_dict() dictionary) and/or written as JSON to 'dump_filename'
+# ('-' for stderr).
+def enable(dump_filename=None, callback=None):
+    global active
+    active = stats = Stats()
+    def finish():
+        if callback is not None:
+            callback(stats.as_dict())
+        if dump_filename == '-':
+            stats.dump(sys.stderr)
+        elif dump_filename is not None:
+            f = open(dump_filename, 'w')
+            stats.dump(f)
+            f.close()
+    atexit.register(finish)
+    return stats
+
+def disable():
+    global active
+    active = None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Merge overlapping Seaward SSS downloads into one de-duplicated stream
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: merge.py merged.sss <input1.sss|input1.gar> ...
+#          merge.py --key identity --index seen.db merged.sss <input1.gar> ...
+#
+# Every record of each input (the 'TestResults.sss' member of a '.gar')
+# is fingerprinted (see payload_fingerprint() and identity_fingerprint()
+# in portableappliancetest.py) and only records not seen before are
+# appended, byte-for-byte, to the merged '.sss' stream.  Corrupt byte
+# ranges are skipped, as with --recover.
+#
+# == Index ==
+# Fingerprints already merged are kept on disk in a SQLite table of
+# 16-byte keys (WITHOUT ROWID, so the B-tree holds nothing else), by
+# default '<merged>.seen'.  Records are handled in batches: each batch
+# is looked up in the index in one pass, its new records are written
+# and flushed, and only then are their fingerprints committed, so a
+# crash can at worst repeat, never lose, a record.  Memory use is one
+# batch plus SQLite's page cache, however many records have been seen.
+
+import optparse
+import sqlite3
+import sys
+
+import portableappliancetest as pat
+
+# Records looked up in, and committed to, the index at a time
+BATCH_RECORDS = 10000
+
+# Bound parameters per lookup query (SQLite allows up to 999)
+LOOKUP_CHUNK = 500
+
+Fingerprints = {'payload': pat.payload_fingerprint,
+                'identity': pat.identity_fingerprint}
+
+class SeenIndex(object):
+    """On-disk set of the fingerprints of records already merged."""
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA cache_size = -65536')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen '
+                                '(fingerprint BLOB PRIMARY KEY) WITHOUT ROWID')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    # Returns the set of 'fingerprints' already in the index
+    def known(self, fingerprints):
+        known = set()
+        for i in xrange(0, len(fingerprints), LOOKUP_CHUNK):
+            chunk = [sqlite3.Binary(f) for f in fingerprints[i:i + LOOKUP_CHUNK]]
+            query = 'SELECT fingerprint FROM seen WHERE fingerprint IN (%s)' % ','.join('?' * len(chunk))
+            known.update([str(row[0]) for row in self.connection.execute(query, chunk)])
+        return known
+
+    def add(self, fingerprints, commit=True):
+        self.connection.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                                    [(sqlite3.Binary(f),) for f in fingerprints])
+        if commit:
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+# The pairs of fingerprint and record in 'batch' which are new, both to
+# the index and within the batch itself
+def unseen(index, batch):
+    known = index.known([fingerprint for fingerprint, record in batch])
+    new = []
+    for fingerprint, record in batch:
+        if fingerprint not in known:
+            known.add(fingerprint)
+            new.append((fingerprint, record))
+    return new
+
+# Write the new records of 'batch'; returns how many were written
+def merge_batch(index, output, batch):
+    new = unseen(index, batch)
+    for fingerprint, record in new:
+        output.write(record.raw())
+    output.flush()
+    index.add([fingerprint for fingerprint, record in new])
+    return len(new)
+
+# Merge the new records of one input; returns the counts of records
+# read, records written and byte ranges skipped.
+def merge_file(index, output, filename, fingerprint=pat.payload_fingerprint):
+    skipped = []
+    count = written = 0
+    batch = []
+    for record in pat.open_records(filename, lambda start, end, error: skipped.append(error)):
+        count += 1
+        batch.append((fingerprint(record), record))
+        if len(batch) >= BATCH_RECORDS:
+            written += merge_batch(index, output, batch)
+            batch = []
+    written += merge_batch(index, output, batch)
+    return count, written, len(skipped)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <merged.sss> <input.sss|input.gar> ...')
+    parser.add_option('--key', choices=sorted(Fingerprints), default='payload',
+                      help='what makes records the same: payload or identity (default: %default)')
+    parser.add_option('--index', metavar='FILE',
+                      help='index of records already merged (default: <merged.sss>.seen)')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+
+    index = SeenIndex(options.index or args[0] + '.seen')
+    output = open(args[0], 'ab')
+    for filename in args[1:]:
+        print 'Merging "%s"' % filename
+        try:
+            count, written, skipped = merge_file(index, output, filename, Fingerprints[options.key])
+        except Exception, e:
+            print 'End File {Error:"%s: %s"}' % (e.__class__.__name__, e)
+            continue
+        print 'Merged {records:%d, new:%d, duplicates:%d, skipped:%d}' % \
+            (count, written, count - written, skipped)
+    output.close()
+    index.close()
+
+if __name__=='__main__':
+    main()
@@ -3,7 +3,7 @@
 # Paul Sladen, 2014-11-25, Seaward SSS PAT testing file format debug harness
 # Hereby placed in the public domain in the hopes of improving
 # electrical safety and interoperability
-# Usage: ./portableappliancetest.py <input.sss>
+# Usage: ./portableappliancetest.py <input.sss|input.gar> ...
 #
 # = PAT Testing =
 # Portable Appliance Testing (PAT Inspections) are tests undertaken on
@@ -69,48 +69,162 @@
 # Suggested work for those interested, could be to:
 # Add option support for newer multi-sample protocol version.
 # Add option to output ASCII is same format as meter (requires example)
-# Add option to output .csv
 
 import struct, sys
+import os
 import string
 import collections
-import StringIO
+import csv
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+import optparse
+import gar
+import instrumentation
+
+# NumPy is only needed for the columnar sss_columns() decoding
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Code is in the main() function at the bottom.  Above are helper
 # classes, and then classes for parsing the 'SSS' format itself.
 
+# Marks a derived field (see 'extra_fields') that has not been set yet
+_unset = object()
+
+# Per-class field layout, computed once and shared by every instance:
+# the compiled struct, the field names (followed by any derived
+# 'extra_fields'), a name -> position index, positions needing
+# conversion after unpacking (strings are stripped, others coerced),
+# and the byte offset of each field within the packed structure.
+sdbLayout = collections.namedtuple('sdbLayout', 'struct names index strings converters offsets')
+
+class sdbMeta(type):
+    """Gives every 'sdb' subclass an empty __slots__ unless it declares
+    its own, so that instances never grow a per-instance __dict__."""
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return type.__new__(mcs, name, bases, namespace)
+
+class sdbData(object):
+    """Dictionary-like view onto the values held by an 'sdb' instance,
+    in field order; only created when something asks for '.data'."""
+    __slots__ = ('record',)
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, key):
+        value = self.record._values[self.record.layout.index[key]]
+        if value is _unset:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        record = self.record
+        if record._values is None:
+            record._values = [_unset] * len(record.layout.names)
+        record._values[record.layout.index[key]] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        values = self.record._values or ()
+        return [(k, v) for k, v in zip(self.record.layout.names, values) if v is not _unset]
+
+    def keys(self):
+        return [k for k, v in self.items()]
+
+    def values(self):
+        return [v for k, v in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def __str__(self):
+        return str(collections.OrderedDict(self.items()))
+
 # Not-invented-here Structured Database Helper class
 class sdb(object):
     """Structured database class, not related to 'SSS' specifically.  It is
     a helper class for describing binary databases and gets used later
     below; variants of 'sdb' have been re-used over the years on various
-    file-format parsers."""
+    file-format parsers.  Values live in a plain list against a layout
+    shared by the whole class, keeping each instance small."""
 
+    __metaclass__ = sdbMeta
+    __slots__ = ('layout', '_values')
     field_pack_format = {int: 'I'}
+    extra_fields = ()
+    layouts = {}
     def __init__(self, endian='<'):
-        self.data = collections.OrderedDict()
+        self._values = None
         self.build_format_string(endian = endian)
 
     def build_format_string(self, endian):
-        self.endian = endian
-        s = ''
-        for name, type, size in self.fields:
-            if type == int and size == 1: s += 'B'
-            elif type == int and size == 2: s += 'H'
-            elif type == int and size == 4: s += 'L'
-            elif type == str:
-                s += str(size) + 's'
-            else:
-                s += self.field_pack_format[type]
-        self.format_string = self.endian + s
-        self.required_length = struct.calcsize(self.format_string)
-        
-    def unpack(self, s):
-        u = list(struct.unpack(self.format_string, s))
-        for name, type, size in self.fields:
-            if type == str:
-                u[0] = u[0].replace('\x00', '').rstrip()
-            self.data[name] = type(u.pop(0))
+        self.layout = self.layout_for(endian)
+
+    @classmethod
+    def layout_for(cls, endian):
+        # The layout is built once per class (and endianness) and
+        # shared by every instance, rather than per instance or call.
+        key = (cls, endian)
+        layout = cls.layouts.get(key)
+        if layout is None:
+            s = ''
+            strings, converters, offsets = [], [], []
+            for i, (name, type, size) in enumerate(cls.fields):
+                offsets.append(struct.calcsize(endian + s))
+                if type == int and size == 1: s += 'B'
+                elif type == int and size == 2: s += 'H'
+                elif type == int and size == 4: s += 'L'
+                elif type == str:
+                    s += str(size) + 's'
+                    strings.append(i)
+                else:
+                    s += cls.field_pack_format[type]
+                    converters.append((i, type))
+            names = tuple([name for name, type, size in cls.fields]) + tuple(cls.extra_fields)
+            index = dict([(name, i) for i, name in enumerate(names)])
+            layout = cls.layouts[key] = sdbLayout(struct.Struct(endian + s), names, index,
+                                                  tuple(strings), tuple(converters), tuple(offsets))
+        return layout
+
+    endian = property(lambda self: self.layout.struct.format[0])
+    struct = property(lambda self: self.layout.struct)
+    format_string = property(lambda self: self.layout.struct.format)
+    required_length = property(lambda self: self.layout.struct.size)
+    data = property(lambda self: sdbData(self))
+
+    def unpack(self, s, offset=0):
+        # 's' may be any buffer (str, memoryview, mmap); fields are
+        # decoded in place starting at 'offset' without slicing.
+        layout = self.layout
+        u = list(layout.struct.unpack_from(s, offset))
+        for i in layout.strings:
+            u[i] = u[i].replace('\x00', '').rstrip()
+        for i, type in layout.converters:
+            u[i] = type(u[i])
+        if self.extra_fields:
+            u.extend([_unset] * len(self.extra_fields))
+        self._values = u
         return self
 
     def headings(self):
@@ -126,34 +240,70 @@ class sdb(object):
         return s
 
     def __len__(self):
-        return self.required_length
+        return self.layout.struct.size
 
     def __str__(self):
         return str(self.data)
 
 # This sub-class for the SSS stream-format, most 
 class SSS(sdb):
+    # Post-processing is described per class, so that it can also be
+    # applied column-at-a-time (see sss_columns()): 'scaled' fields
+    # hold a 2-bit decimal exponent over a 14-bit mantissa, 'flags'
+    # are pass when exactly one, 'nonzero_flags' pass when non-zero,
+    # and 'no_result' fields read "(no result)" when they scale to 0.
+    scaled = ()
+    flags = ()
+    nonzero_flags = ()
+    no_result = ()
+
     def __init__(self):
         super(SSS, self).__init__(endian='>')
-        
+
+    @classmethod
+    def size(cls):
+        return cls.layout_for('>').struct.size
+
+    @classmethod
+    def field_offset(cls, name):
+        layout = cls.layout_for('>')
+        return layout.offsets[layout.index[name]]
+
     def fixup(self):
-        pass
-    def unpack(self, s):
-        r = super(SSS, self).unpack(s)
+        for key in self.scaled:
+            self.rescale(key)
+        for key in self.flags:
+            self.passed(key)
+        for key in self.nonzero_flags:
+            self.data[key] = bool(self.data[key])
+        for key in self.no_result:
+            if self.data[key] == 0.0:
+                self.data[key] = '(no result)'
+    def unpack(self, s, offset=0):
+        r = super(SSS, self).unpack(s, offset)
         r.fixup()
         return self
     def rescale(self, key):
-        self.data[key] = (10**-(self.data[key] >> 14)) * (self.data[key] & 0x3fff)
+        i = self.layout.index[key]
+        v = self._values[i]
+        self._values[i] = (10**-(v >> 14)) * (v & 0x3fff)
     def passed(self, key = 'pass'):
-        self.data[key] = bool(self.data[key] == 1)
+        i = self.layout.index[key]
+        self._values[i] = bool(self._values[i] == 1)
+
+# Summing a bytearray is done in C, several times quicker than ord()-ing
+# each character; 'payload' may be a str or any buffer.
+def sss_checksum(payload):
+    return sum(bytearray(payload)) & 0xffff
 
 class SSSRecordHeader(SSS):
     fields = [('payload_length', int, 2),
               ('nulls', int, 2),
               ('checksum_header', int, 2)]
+    extra_fields = ('checksum_payload', 'checksum_match')
     def checksum(self, payload):
         # checksum is the sum value of all the bytes in the payload portion
-        self.data['checksum_payload'] = sum(map(ord,payload)) & 0xffff
+        self.data['checksum_payload'] = sss_checksum(payload)
         match = (self.data['checksum_header'] == self.data['checksum_payload'])
         self.data['checksum_match'] = match
         return match
@@ -178,101 +328,84 @@ class SSSNoDataTest(SSS):
 class SSSEarthResistanceTest(SSS):
     fields = [('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
+    scaled = ('resistance',)
 
 class SSSEarthResistanceTestv2(SSS):
     fields = [('current', int, 1),
               ('pass', int, 1),
               ('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
-        self.passed()
+    scaled = ('resistance',)
+    flags = ('pass',)
 
 class SSSEarthInsulationTest(SSS):
     fields = [('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
-        # Note: the displayed resistance for the Earth Insulation test
-        # is capped at 19.99 MOhms or 99.99 MOhms depending upon the
-        # model of meter.  Internally the meters appears to treat
-        # infinity as somewhere around 185 MOhms and stores the actual
-        # value measured (this is needed for calibration situations).
-        # For simple result reporting, the value is capped to 99.99
-        # MOhms, inline which what other software (and the meter's
-        # display) does.
-        #self.data['resistance'] = min(99.99, 0.01 * (self.data['resistance'] & 0x7fff))
+    scaled = ('resistance',)
+    # Note: the displayed resistance for the Earth Insulation test
+    # is capped at 19.99 MOhms or 99.99 MOhms depending upon the
+    # model of meter.  Internally the meters appears to treat
+    # infinity as somewhere around 185 MOhms and stores the actual
+    # value measured (this is needed for calibration situations).
+    # For simple result reporting, the value is capped to 99.99
+    # MOhms, inline which what other software (and the meter's
+    # display) does.
+    #self.data['resistance'] = min(99.99, 0.01 * (self.data['resistance'] & 0x7fff))
 
 class SSSCurrentTest(SSS):
     fields = [('current', int, 2),
               ]
-    def fixup(self):
-        self.rescale('current')
+    scaled = ('current',)
 
 class SSSCurrentTestv2(SSS):
     fields = [('pass', int, 1),
               ('current', int, 2),
               ]
-    def fixup(self):
-        self.rescale('current')
-        self.passed()
+    scaled = ('current',)
+    flags = ('pass',)
 
 class SSSEarthInsulationTestv2(SSS):
     fields = [('pass', int, 1),
               ('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
-        self.passed()
+    scaled = ('resistance',)
+    flags = ('pass',)
 
 class SSSPowerLeakTest(SSS):
     fields = [('leakage', int, 2),
               ('load', int, 2),
               ]
-    def fixup(self):
-        # Note: The 10/16ths current (load) scaling factor was
-        # obtained from a sample size of two results only, both of
-        # which were the same... Caveat emptor!
-        self.rescale('leakage')
-        self.rescale('load')
+    # Note: The 10/16ths current (load) scaling factor was
+    # obtained from a sample size of two results only, both of
+    # which were the same... Caveat emptor!
+    scaled = ('leakage', 'load')
 
 class SSSPowerLeakTestv2(SSS):
     fields = [('pass', int, 1),
               ('leakage', int, 2),
               ('load', int, 2),
               ]
-    def fixup(self):
-        self.data['pass'] = bool(self.data['pass'])
-        self.rescale('leakage')
-        self.rescale('load')
+    scaled = ('leakage', 'load')
+    nonzero_flags = ('pass',)
 
 class SSSContinuityTest(SSS):
     fields = [('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
-        # Zero appears to correspond to infinity (no connection).
-        # Which at least one other output software apparently shows as
-        # "(no result)", instead of a numerical value.  This reported
-        # behaviour is copied here.
-        if self.data['resistance'] == 0.0:
-            self.data['resistance'] = '(no result)'
+    scaled = ('resistance',)
+    # Zero appears to correspond to infinity (no connection).
+    # Which at least one other output software apparently shows as
+    # "(no result)", instead of a numerical value.  This reported
+    # behaviour is copied here.
+    no_result = ('resistance',)
 
 class SSSContinuityTestv2(SSS):
     fields = [('pass', int, 1),
               ('resistance', int, 2),
               ]
-    def fixup(self):
-        self.rescale('resistance')
-        self.passed()
-        # Zero appears to correspond to infinity (no connection).
-        # Which at least one other output software apparently shows as
-        # "(no result)", instead of a numerical value.  This reported
-        # behaviour is copied here.
-        if self.data['resistance'] == 0.0:
-            self.data['resistance'] = '(no result)'
+    scaled = ('resistance',)
+    flags = ('pass',)
+    # Zero appears to correspond to infinity (no connection), see above.
+    no_result = ('resistance',)
 
 class SSSUserDataMappingTest(SSS):
     fields = [('mapping1', int, 1),
@@ -286,6 +419,7 @@ class SSSUserDataMappingTest(SSS):
                 3: 'Make',
                 4: 'Model',
                 5: 'Serial No.'}
+    extra_fields = ('meaning1', 'meaning2', 'meaning3', 'meaning4')
     def fixup(self):
         for k,v in self.data.items():
             self.data['meaning' + k[-1]] = self.mappings[v]
@@ -356,59 +490,729 @@ TestsVersion2 = {
     0xf9: ('Lead Continuity Pass (F9)', SSSNoDataTest),
     }
 
+# Type codes of the visual test sub-record, and of those marking a fail
+VisualTestCodes = (0x01, 0x02, 0x11, 0x12)
+FailTestCodes = (0x02, 0x12, 0xf1)
+
+# Decoder compiler: for each test class a specialised decode(buf,
+# offset) function is generated from its field layout, with the
+# string stripping, rescale(), passed() and "(no result)" handling
+# written out inline, so that decoding a sub-field is one unpack_from()
+# plus straight-line code instead of the generic unpack()/fixup() loops.
+# Classes with their own fixup() keep the generic path.
+def compile_decoder(test_class):
+    if test_class.fixup.im_func is not SSS.fixup.im_func:
+        def decode(buf, offset):
+            return test_class().unpack(buf, offset)
+        return decode
+
+    layout = test_class.layout_for('>')
+    namespace = {'unpack_from': layout.struct.unpack_from,
+                 'new': object.__new__,
+                 'cls': test_class,
+                 'layout': layout,
+                 'unset': _unset}
+    v = ['v%d' % i for i in range(len(test_class.fields))]
+    lines = ['def decode(buf, offset):']
+    if v:
+        lines.append('    %s, = unpack_from(buf, offset)' % ', '.join(v))
+    for i in layout.strings:
+        lines.append("    %s = %s.replace('\\x00', '').rstrip()" % (v[i], v[i]))
+    for i, type in layout.converters:
+        namespace['convert%d' % i] = type
+        lines.append('    %s = convert%d(%s)' % (v[i], i, v[i]))
+    for name in test_class.scaled:
+        i = layout.index[name]
+        lines.append('    %s = (10**-(%s >> 14)) * (%s & 0x3fff)' % (v[i], v[i], v[i]))
+    for name in test_class.flags:
+        i = layout.index[name]
+        lines.append('    %s = %s == 1' % (v[i], v[i]))
+    for name in test_class.nonzero_flags:
+        i = layout.index[name]
+        lines.append('    %s = bool(%s)' % (v[i], v[i]))
+    for name in test_class.no_result:
+        i = layout.index[name]
+        lines.append("    if %s == 0.0: %s = '(no result)'" % (v[i], v[i]))
+    lines.append('    t = new(cls)')
+    lines.append('    t.layout = layout')
+    lines.append('    t._values = [%s]' % ', '.join(v + ['unset'] * len(test_class.extra_fields)))
+    lines.append('    return t')
+    exec '\n'.join(lines) in namespace
+    return namespace['decode']
+
+# Dispatch tables of 256 entries indexed directly by the type byte,
+# built once at import time from TestsVersion1/TestsVersion2; the
+# version 2 table already has the version 1 entries merged beneath it.
+SSSDispatch = collections.namedtuple('SSSDispatch', 'name test_class size decode')
+
+def build_dispatch(*tables):
+    dispatch = [None] * 256
+    for table in tables:
+        for test_type, (name, test_class) in table.items():
+            dispatch[test_type] = SSSDispatch(name, test_class, test_class.size(),
+                                              compile_decoder(test_class))
+    return dispatch
+
+DispatchVersion1 = build_dispatch(TestsVersion1)
+DispatchVersion2 = build_dispatch(TestsVersion1, TestsVersion2)
+
 class SSSSyntaxError(SyntaxError):
     pass
 
-def parse_sss(filehandle):
-    f = filehandle
-    r = SSSRecordHeader()
-    for header in iter(lambda: f.read(len(r)), ''):
-        Tests = TestsVersion1.copy()
+# A decoded sub-record: its one-byte type code, the descriptive name
+# from TestsVersion1/TestsVersion2, and the unpacked 'SSS' instance.
+SSSSubRecord = collections.namedtuple('SSSSubRecord', 'type_code name test')
+
+class SSSRecord(object):
+    """A single record from an 'SSS' stream.  The header is decoded and
+    the checksum verified up-front, while the sub-records are only
+    decoded from the payload as the caller iterates subrecords().
+    'offset' is where the record's header starts within the stream."""
+
+    # Set (per record) while instrumentation is on, see _record_factory()
+    stats = None
+
+    def __init__(self, header, payload, offset=None):
+        self.header = header
+        self.payload = payload
+        self.offset = offset
+        self.validated = header.checksum(payload)
+        self._version = None
+        self._index = None
+
+    def error(self):
+        if self.header.data['payload_length'] == 0:
+            return 'Zero length payload'
+        if not self.validated:
+            return 'Checksum validation failed'
+        return None
+
+    def check(self):
+        error = self.error()
+        if error is not None:
+            raise SSSSyntaxError(error)
+
+    @property
+    def version(self):
+        # Only known once the sub-records have been walked
+        if self._version is None:
+            self.index()
+        return self._version
+
+    def spans(self):
+        # Locate each sub-field without decoding it, yielding its type
+        # code, SSSDispatch entry, starting offset and the version in force.
+        self.check()
+        Tests = DispatchVersion1
         version = 1
 
-        r.unpack(header)
-        payload = f.read(r.data['payload_length'])
-        validated = r.checksum(payload)
-        #print 'Checksum {pass: %s}' % bool(checksum == r.data['checksum'])
-        print 'New Record', r.items_dict()
-        if r.data['payload_length'] == 0:
-            raise SSSSyntaxError('Zero length payload')
-        if not validated:
-            raise SSSSyntaxError('Checksum validation failed')
-            return
+        # Walk the payload with a running offset rather than re-slicing it
+        payload = self.payload
+        offset, end = 0, len(payload)
         test_type = None
-        while len(payload) and test_type != 0xff:
-            test_type = ord(payload[0])
-            payload = payload[1:]
+        while offset < end and test_type != 0xff:
+            test_type = ord(payload[offset])
+            offset += 1
             # Add in newer-style records if detected by presence of 0x11/0x12
             if version == 1 and test_type in (0x11, 0x12):
                 version += 1
-                Tests.update(TestsVersion2)
-            t = Tests[test_type][1]()
-            # Unpack the current sub-field
-            t.unpack(payload[:len(t)])
-            print Tests[test_type][0], t.items_dict()
+                Tests = DispatchVersion2
+            entry = Tests[test_type]
+            if entry is None:
+                raise KeyError(test_type)
+            yield test_type, entry, offset, version
 
             # Seek past to start of next sub-field
-            payload = payload[len(t):]
-            #print `payload`
+            offset += entry.size
+        self._version = version
+
+    def subrecords(self, type_codes=None):
+        # Decodes every sub-field, or only those with the given type codes
+        view = memoryview(self.payload)
+        stats = self.stats
+        for test_type, entry, offset, version in self.spans():
+            if type_codes is None or test_type in type_codes:
+                # Unpack the current sub-field
+                if stats is None:
+                    test = entry.decode(view, offset)
+                else:
+                    test = stats.call('sss.decode.%02x' % test_type, entry.decode, view, offset)
+                    stats.count('sss.subrecords.%02x' % test_type)
+                yield SSSSubRecord(test_type, entry.name, test)
+
+    # Lazy view: index() finds where each sub-field starts, and its type
+    # code, once; individual sub-fields are then only decoded on access.
+    def index(self):
+        if self._index is None:
+            self._index = list(self.spans())
+        return self._index
+
+    def type_codes(self):
+        return [span[0] for span in self.index()]
+
+    def decode(self, span):
+        test_type, entry, offset, version = span
+        if self.stats is None:
+            test = entry.decode(self.payload, offset)
+        else:
+            test = self.stats.call('sss.decode.%02x' % test_type, entry.decode, self.payload, offset)
+            self.stats.count('sss.subrecords.%02x' % test_type)
+        return SSSSubRecord(test_type, entry.name, test)
+
+    def find(self, type_code):
+        for span in self.index():
+            if span[0] == type_code:
+                return self.decode(span)
+        return None
+
+    # The record as it appeared in the stream, header and payload
+    def raw(self):
+        h = self.header.data
+        return struct.pack('>HHH', h['payload_length'], h['nulls'], h['checksum_header']) + str(self.payload)
+
+    def failed(self):
+        for span in self.index():
+            if span[0] in FailTestCodes:
+                return True
+        return False
+
+# Returns what the record iterators call to build each SSSRecord: the
+# class itself, or with instrumentation on, a wrapper that times the
+# construction (where the checksum is verified) and counts records,
+# bytes and checksum failures.
+def _record_factory(stats):
+    if stats is None:
+        return SSSRecord
+    header_length = SSSRecordHeader.size()
+    new_record = stats.timed('sss.checksum', SSSRecord)
+    def instrumented_record(header, payload, offset):
+        record = new_record(header, payload, offset)
+        record.stats = stats
+        stats.count('sss.records')
+        stats.count('sss.bytes', header_length + len(payload))
+        if not record.validated:
+            stats.count('sss.checksum_failures')
+        return record
+    return instrumented_record
+
+# Generator yielding an SSSRecord for each record in the stream, only
+# reading as far into 'filehandle' as the caller has iterated.
+def iter_sss(filehandle):
+    f = filehandle
+    read, new_record = f.read, _record_factory(instrumentation.active)
+    if instrumentation.active is not None:
+        read = instrumentation.active.timed('sss.read', read)
+    header_length = len(SSSRecordHeader())
+    offset = 0
+    for header in iter(lambda: read(header_length), ''):
+        r = SSSRecordHeader().unpack(header)
+        payload = read(r.data['payload_length'])
+        yield new_record(r, payload, offset)
+        offset += header_length + len(payload)
+
+# Look for the next offset at or after 'offset' where a plausible record
+# starts: a six-byte header whose middle word is null, with a payload
+# length that fits within 'data', a known first sub-record type code,
+# and a payload that sums to the header's checksum.  Candidates are
+# found by searching for the null word, so the scan runs at find() speed.
+def resync_sss(data, offset):
+    header_length = SSSRecordHeader.size()
+    end = len(data)
+    position = data.find('\x00\x00', offset + 2)
+    while position != -1:
+        start = position - 2
+        if start + header_length < end:
+            payload_length, nulls, checksum = struct.unpack_from('>HHH', data, start)
+            payload_start = start + header_length
+            if (0 < payload_length <= end - payload_start and
+                DispatchVersion2[ord(data[payload_start])] is not None and
+                sss_checksum(buffer(data, payload_start, payload_length)) == checksum):
+                return start
+        position = data.find('\x00\x00', position + 1)
+    return None
+
+# Generator yielding an SSSRecord for each record held in 'data', which
+# may be a str or anything else with the buffer interface, notably an
+# mmap of the whole file.  Records are walked with a running offset and
+# each payload is a buffer() onto 'data', so nothing is copied.
+#
+# By default a corrupt record is yielded as-is and raises SSSSyntaxError
+# when its sub-records are read.  Given a 'recover' callable, corrupt or
+# truncated records are instead skipped: resync_sss() finds the next
+# plausible record, recover(start, end, error) is called with the byte
+# range skipped, and parsing resumes from there.
+def iter_sss_buffer(data, offset=0, recover=None):
+    header_length = SSSRecordHeader.size()
+    new_record = _record_factory(instrumentation.active)
+    end = len(data)
+    while offset < end:
+        if recover is not None and end - offset < header_length:
+            recover(offset, end, 'Truncated header')
+            return
+        r = SSSRecordHeader().unpack(data, offset)
+        payload_length = r.data['payload_length']
+        record = new_record(r, buffer(data, offset + header_length, payload_length), offset)
+        if recover is not None:
+            if len(record.payload) < payload_length:
+                error = 'Truncated payload'
+            else:
+                error = record.error()
+            if error is not None:
+                resume = resync_sss(data, offset + 1)
+                recover(offset, end if resume is None else resume, error)
+                if resume is None:
+                    return
+                offset = resume
+                continue
+        yield record
+        offset += header_length + payload_length
+
+# Map an '.sss' file read-only into memory for iter_sss_buffer().  Files
+# that cannot be mapped (empty files, pipes) are simply read instead.
+def map_sss(filename):
+    f = open(filename, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        return f.read()
+    finally:
+        f.close()
+
+# == Filter pushdown ==
+# Select records by the type codes they contain, overall pass/fail, and
+# site or asset id prefix.  All of these are tested on the raw payload
+# bytes before any sub-field is decoded: the visual test is normally the
+# first sub-field, so its site and asset id can be compared in place
+# without even walking the payload; otherwise the (undecoded) index of
+# sub-fields is used.  With no predicates the records pass straight through.
+VisualIdOffset = SSSVisualTest.field_offset('id')
+VisualSiteOffset = SSSVisualTest.field_offset('site')
+
+def _visual_offset(record):
+    if len(record.payload) and ord(record.payload[0]) in VisualTestCodes:
+        return 1
+    for test_type, entry, offset, version in record.index():
+        if test_type in VisualTestCodes:
+            return offset
+    return None
+
+def _raw_prefix(record, field_offset, prefix):
+    offset = _visual_offset(record)
+    if offset is None:
+        return False
+    start = offset + field_offset
+    return record.payload[start:start + len(prefix)] == prefix
+
+def filter_records(records, type_codes=None, passed=None, site=None, asset=None):
+    if type_codes is None and passed is None and site is None and asset is None:
+        return records
+    return _filter_records(records, type_codes, passed, site, asset)
+
+def _filter_records(records, type_codes, passed, site, asset):
+    for record in records:
+        if asset is not None and not _raw_prefix(record, VisualIdOffset, asset):
+            continue
+        if site is not None and not _raw_prefix(record, VisualSiteOffset, site):
+            continue
+        if passed is not None and record.failed() == passed:
+            continue
+        if type_codes is not None and not set(type_codes).intersection(record.type_codes()):
+            continue
+        yield record
+
+# == Fingerprints ==
+# Meters re-export their whole memory, so the same record turns up in
+# many downloads.  A record's fingerprint is the MD5 of its header
+# checksum and raw payload; or, keyed on identity, of the raw asset id
+# and test date/time from its visual test plus the meter serial number
+# from its software version sub-field (records lacking either fall back
+# to the payload).  Neither needs any sub-field decoding.
+VisualIdentityLength = SSSVisualTest.field_offset('site')
+SerialNumberLength = SSSSoftwareVersionTest.field_offset('firmware1')
+
+def payload_fingerprint(record):
+    h = hashlib.md5(struct.pack('>H', record.header.data['checksum_header']))
+    h.update(record.payload)
+    return h.digest()
+
+def identity_fingerprint(record):
+    visual = _visual_offset(record)
+    serial = None
+    for test_type, entry, offset, version in record.index():
+        if test_type == 0xfe:
+            serial = offset
+    if visual is None or serial is None:
+        return payload_fingerprint(record)
+    h = hashlib.md5('identity')
+    h.update(record.payload[visual:visual + VisualIdentityLength])
+    h.update(record.payload[serial:serial + SerialNumberLength])
+    return h.digest()
+
+# Debug dump of every record and sub-field
+def dump_records(records):
+    for record in records:
+        print 'New Record', record.header.items_dict()
+        for subrecord in record.subrecords():
+            print subrecord.name, subrecord.test.items_dict()
 
         # Line-break between records.
         print
 
+def parse_sss(filehandle):
+    dump_records(iter_sss(filehandle))
+
+def parse_sss_buffer(data, recover=None):
+    dump_records(iter_sss_buffer(data, recover=recover))
+
+# Debug dump of a byte range skipped in recovery mode
+def dump_skipped(start, end, error):
+    print 'Skipped {start:%d, end:%d, error:"%s"}' % (start, end, error)
+    print
+
+# Columnar decoding: every sub-record of one type code (and format
+# version) across all of 'records' is gathered as raw bytes and viewed
+# as a NumPy structured array in one go, with the scaling and pass
+# flags then applied a whole column at a time.  Each row is joined
+# with the asset id, date/time, site, location and tester from its
+# record's visual test.  '(no result)' readings become NaN.
+def _numpy_dtype(test_class):
+    return numpy.dtype([(name, 'S%d' % size if type == str else '>u%d' % size)
+                        for name, type, size in test_class.fields])
+
+def sss_columns(records, type_code, version=1):
+    if numpy is None:
+        raise ImportError('sss_columns() requires NumPy')
+    Tests = TestsVersion2 if version == 2 and type_code in TestsVersion2 else TestsVersion1
+    wanted = Tests[type_code][1]
+    size, visual_size = wanted.size(), SSSVisualTest.size()
+
+    rows, visuals = [], []
+    for record in records:
+        payload, visual = record.payload, None
+        for test_type, entry, offset, record_version in record.spans():
+            if test_type in VisualTestCodes:
+                visual = payload[offset:offset + visual_size]
+            elif test_type == type_code and entry.test_class is wanted and record_version == version:
+                rows.append(payload[offset:offset + size])
+                visuals.append(visual or '\x00' * visual_size)
+
+    raw = numpy.frombuffer(''.join(rows), dtype=_numpy_dtype(wanted))
+    vis = numpy.frombuffer(''.join(visuals), dtype=_numpy_dtype(SSSVisualTest))
+
+    columns = [('id', 'S16'), ('datetime', 'M8[m]'), ('site', 'S16'),
+               ('location', 'S16'), ('tester', 'S11')]
+    for name, type, size in wanted.fields:
+        if name in wanted.scaled:
+            columns.append((name, 'f8'))
+        elif name in wanted.flags or name in wanted.nonzero_flags:
+            columns.append((name, '?'))
+        else:
+            columns.append((name, 'S%d' % size if type == str else 'u%d' % size))
+    out = numpy.empty(len(raw), dtype=columns)
+
+    for name in ('id', 'site', 'location', 'tester'):
+        out[name] = numpy.char.rstrip(numpy.char.replace(vis[name], '\x00', ''))
+    out['datetime'] = ((vis['year'].astype('i8') - 1970).astype('M8[Y]')
+                       + (vis['month'].astype('i8') - 1).astype('m8[M]')
+                       + (vis['day'].astype('i8') - 1).astype('m8[D]')
+                       + vis['hour'].astype('m8[h]')
+                       + vis['minute'].astype('m8[m]'))
+
+    for name, type, size in wanted.fields:
+        column = raw[name]
+        if name in wanted.scaled:
+            column = (column & 0x3fff) * (10.0 ** -(column >> 14).astype('i8'))
+            if name in wanted.no_result:
+                column[column == 0.0] = numpy.nan
+        elif name in wanted.flags:
+            column = column == 1
+        elif name in wanted.nonzero_flags:
+            column = column != 0
+        elif type == str:
+            column = numpy.char.rstrip(numpy.char.replace(column, '\x00', ''))
+        out[name] = column
+    return out
+
+# == CSV / JSON Lines export ==
+# Each record is flattened to one row: where it came from, the visual
+# test fields, then a group of columns for every known test type code,
+# named by type code (with 'v2' for the version 2 layouts) and taken
+# from the headings() of the classes in TestsVersion1/TestsVersion2,
+# eg. 'F2_resistance' or 'F2v2_pass'.  Sub-records without fields,
+# such as 'F0' (overall pass), get a single column marking presence.
+# Rows are written as records are parsed, through a large buffer.
+EXPORT_BUFFER_SIZE = 1 << 20
+
+def export_groups():
+    groups = {}
+    for version, table in ((1, TestsVersion1), (2, TestsVersion2)):
+        for test_type, (name, test_class) in table.items():
+            if test_type in VisualTestCodes:
+                continue
+            prefix = '%02X%s' % (test_type, 'v2' if version == 2 else '')
+            headings = test_class().headings()
+            columns = [prefix + '_' + heading for heading in headings] or [prefix]
+            groups[(version, test_type)] = (prefix, headings, columns)
+    return groups
+
+ExportGroups = export_groups()
+ExportColumns = (['source', 'offset', 'version', 'failed', 'visual'] +
+                 SSSVisualTest().headings() +
+                 [column for key in sorted(ExportGroups) for column in ExportGroups[key][2]])
+
+def flatten_record(record, source=None):
+    row = {'source': source, 'offset': record.offset, 'failed': record.failed()}
+    for span in record.index():
+        test_type, entry, offset, version = span
+        test = record.decode(span).test
+        if test_type in VisualTestCodes:
+            row['visual'] = '%02X' % test_type
+            row.update(test.data.items())
+            continue
+        if version == 2 and test_type in TestsVersion2:
+            prefix, headings, columns = ExportGroups[(2, test_type)]
+        else:
+            prefix, headings, columns = ExportGroups[(1, test_type)]
+        if not headings:
+            row[prefix] = True
+        for heading, column in zip(headings, columns):
+            row[column] = test.data[heading]
+    row['version'] = record.version
+    return row
+
+class CSVExporter(object):
+    def __init__(self, output):
+        self.writer = csv.DictWriter(output, ExportColumns)
+        self.writer.writeheader()
+
+    def write(self, records, source=None):
+        writerow = self.writer.writerow
+        for record in records:
+            writerow(flatten_record(record, source))
+
+class JSONLinesExporter(object):
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, records, source=None):
+        write = self.output.write
+        for record in records:
+            row = flatten_record(record, source)
+            ordered = collections.OrderedDict([(k, row[k]) for k in ExportColumns if k in row])
+            write(json.dumps(ordered, encoding='latin-1') + '\n')
+
+# The SSS stream of an '.sss' file (memory-mapped), or of the
+# 'TestResults.sss' decoded in memory from inside a '.gar' container.
+def load_sss(filename):
+    if filename.lower().endswith('.gar'):
+        return gar.gar_read_member(filename, 'TestResults.sss')
+    return map_sss(filename)
+
+def open_records(filename, recover=None):
+    return iter_sss_buffer(load_sss(filename), recover=recover)
+
+# == Incremental ingest ==
+# As SSS streams have no file header, files from the same meter grow
+# by having records appended.  For each file the offset, end and
+# checksum of the last fully parsed record are kept in a JSON state
+# file; next time, if that record is still found intact at the same
+# place, parsing resumes from its end and only the new records are
+# decoded.  Otherwise (the file was replaced or rewritten) the whole
+# file is parsed again.
+class SSSIngestState(object):
+    """Per-file resume points for incremental ingest, persisted as JSON.
+    With no 'state_filename' the caller keeps 'files' itself."""
+
+    def __init__(self, state_filename=None):
+        self.state_filename = state_filename
+        self.files = {}
+        if state_filename is not None and os.path.exists(state_filename):
+            self.files = json.load(open(state_filename))
+
+    def save(self):
+        # Written to the side and renamed into place, so an interrupted
+        # run never leaves a half-written state file behind.
+        temporary = self.state_filename + '.tmp'
+        f = open(temporary, 'w')
+        json.dump(self.files, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(temporary, self.state_filename)
+
+    def resume_offset(self, key, data):
+        entry = self.files.get(key)
+        if entry is None:
+            return 0
+        offset, end, checksum = entry['offset'], entry['end'], entry['checksum']
+        header_length = SSSRecordHeader.size()
+        if end > len(data) or end - offset < header_length:
+            return 0
+        payload_length, nulls, checksum_header = struct.unpack_from('>HHH', data, offset)
+        if offset + header_length + payload_length != end or checksum_header != checksum:
+            return 0
+        if sss_checksum(buffer(data, offset + header_length, payload_length)) != checksum:
+            return 0
+        return end
+
+    # Yields only the records added since the last run.  A record is
+    # marked as parsed once the caller asks for the next one, so records
+    # which raise (or are never reached) are parsed again next time.
+    def new_records(self, filename, recover=None):
+        key = os.path.abspath(filename)
+        data = load_sss(filename)
+        offset = self.resume_offset(key, data)
+        header_length = SSSRecordHeader.size()
+        for record in iter_sss_buffer(data, offset, recover):
+            yield record
+            if record.error() is None:
+                self.files[key] = {'offset': record.offset,
+                                   'end': record.offset + header_length + len(record.payload),
+                                   'checksum': record.header.data['checksum_header']}
+
+# == Batch mode ==
+# Many files are summarised in parallel by a process pool, with the
+# summaries handed back in the same order as the inputs.  A record
+# counts as a fail if it has a visual fail or overall fail sub-record,
+# and as a pass otherwise.  Corrupt records are skipped and counted as
+# errors, and any file which cannot be read at all is reported with
+# its error message rather than stopping the batch.
+SSSFileSummary = collections.namedtuple('SSSFileSummary',
+    'filename records passes fails errors message')
+
+def summarise_file(filename):
+    skipped = []
+    records = fails = 0
+    message = None
+    try:
+        for record in open_records(filename, lambda start, end, error: skipped.append(error)):
+            records += 1
+            fails += record.failed()
+    except Exception, e:
+        message = '%s: %s' % (e.__class__.__name__, e)
+    errors = len(skipped) + (message is not None)
+    return SSSFileSummary(filename, records, records - fails, fails, errors, message)
+
+# Expand directories (recursively) and glob patterns into '.sss'/'.gar' files
+def find_inputs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(('.sss', '.gar')):
+                        yield os.path.join(root, name)
+        else:
+            for filename in sorted(glob.glob(path)) or [path]:
+                yield filename
+
+def batch_summaries(paths, processes=None):
+    pool = multiprocessing.Pool(processes)
+    try:
+        for summary in pool.imap(summarise_file, find_inputs(paths), 16):
+            yield summary
+    finally:
+        pool.terminate()
+
+def print_batch(paths, processes=None):
+    totals = [0, 0, 0, 0, 0]
+    for summary in batch_summaries(paths, processes):
+        print 'File {filename:%r, records:%d, passes:%d, fails:%d, errors:%d}' % summary[:5]
+        if summary.message is not None:
+            print 'End File {Error:"%s"}' % summary.message
+        totals = [a + b for a, b in zip(totals, [1] + list(summary[1:5]))]
+    print 'Total {files:%d, records:%d, passes:%d, fails:%d, errors:%d}' % tuple(totals)
+
+# Export every input to one CSV/JSON Lines output; as the output may
+# be stdout, problems (and skipped byte ranges) are reported on stderr.
+def export(filenames, output_filename, exporter_class, selected=filter_records, recover=False):
+    def skipped(start, end, error):
+        print >>sys.stderr, '%s: skipped bytes %d-%d: %s' % (filename, start, end, error)
+    recover = skipped if recover else None
+
+    if output_filename == '-':
+        output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', EXPORT_BUFFER_SIZE)
+    else:
+        output = open(output_filename, 'wb', EXPORT_BUFFER_SIZE)
+    exporter = exporter_class(output)
+    for filename in filenames:
+        try:
+            if filename == '-':
+                records = iter_sss_buffer(sys.stdin.read(), recover=recover)
+            else:
+                records = open_records(filename, recover)
+            exporter.write(selected(records), filename)
+        except Exception, e:
+            print >>sys.stderr, '%s: %s: %s' % (filename, e.__class__.__name__, e)
+    output.close()
+
 def main():
-    if len (sys.argv) < 2:
-        print >>sys.stderr, "usage: %s [input.sss]" % sys.argv[0]
+    parser = optparse.OptionParser(usage='%prog [options] <input.sss|input.gar|-> ...')
+    parser.add_option('--recover', action='store_true', default=False,
+                      help='skip past corrupt or truncated records instead of stopping')
+    parser.add_option('--batch', action='store_true', default=False,
+                      help='summarise files, directories or glob patterns in parallel')
+    parser.add_option('-j', '--jobs', type='int', default=None, metavar='N',
+                      help='number of worker processes in batch mode (default: one per CPU)')
+    parser.add_option('--incremental', metavar='STATE',
+                      help='only show records added since the last run, tracked in STATE')
+    parser.add_option('--type', action='append', dest='type_codes', metavar='CODE',
+                      help='only show records containing this type code, eg. F2 (may be repeated)')
+    parser.add_option('--passes', action='store_const', const=True, dest='passed',
+                      help='only show records which passed')
+    parser.add_option('--fails', action='store_const', const=False, dest='passed',
+                      help='only show records which failed')
+    parser.add_option('--site', metavar='PREFIX', help='only show records whose site starts with PREFIX')
+    parser.add_option('--asset', metavar='PREFIX', help='only show records whose asset id starts with PREFIX')
+    parser.add_option('--csv', metavar='FILE', help='write records as CSV to FILE (- for stdout)')
+    parser.add_option('--jsonl', metavar='FILE', help='write records as JSON Lines to FILE (- for stdout)')
+    parser.add_option('--stats', metavar='FILE',
+                      help='write per-stage counters and timings as JSON to FILE (- for stderr) at exit')
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_usage(sys.stderr)
         sys.exit(2)
+    if options.stats and options.batch:
+        # Workers' counters would not be gathered back, see instrumentation.py
+        parser.error('--stats cannot be used with --batch')
+    if options.csv and options.jsonl:
+        parser.error('--csv and --jsonl cannot be used together')
+    if options.stats:
+        instrumentation.enable(options.stats)
+    if options.batch:
+        print_batch(args, options.jobs)
+        return
+    recover = dump_skipped if options.recover else None
+    type_codes = None
+    if options.type_codes:
+        type_codes = [int(code, 16) for code in options.type_codes]
+    def selected(records):
+        return filter_records(records, type_codes, options.passed, options.site, options.asset)
+
+    if options.csv or options.jsonl:
+        export(args, options.csv or options.jsonl, CSVExporter if options.csv else JSONLinesExporter,
+               selected, options.recover)
+        return
 
+    if options.incremental:
+        state = SSSIngestState(options.incremental)
+        for filename in args:
+            print 'trying "%s"' % filename
+            try:
+                dump_records(selected(state.new_records(filename, recover)))
+            except SSSSyntaxError, message:
+                print 'End File {Error:"%s"}' % message
+            state.save()
+        return
     # Simplify testing/dumping by allowing multiple input files on the command-line
-    for filename in sys.argv[1:]:
+    for filename in args:
         print 'trying "%s"' % filename
-        f = open(filename, 'r')
-        contents = f.read()
-        wrapped = StringIO.StringIO(contents)
         try:
-            parse_sss(wrapped)
+            if filename == '-' and recover is None:
+                records = iter_sss(sys.stdin)
+            elif filename == '-':
+                records = iter_sss_buffer(sys.stdin.read(), recover=recover)
+            else:
+                records = open_records(filename, recover)
+            dump_records(selected(records))
         except SSSSyntaxError, message:
             print 'End File {Error:"%s"}' % message
             continue
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Seaward SSS PAT testing results, summarised in one streaming pass
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: report.py [--by site|location|tester] <input1.sss|input1.gar> ...
+#          report.py --summary summary.db <input1.sss|input1.gar> ...
+#
+# Records are consumed as they are parsed and folded into aggregates,
+# overall and per site, location and tester: records, passes and fails;
+# retest frequencies (SSSRetestTest.frequency, in months) and the month
+# each retest falls due; and, for every numeric field of every test type,
+# its distribution.  Nothing is kept per record.
+#
+# == Merging ==
+# Every aggregate can be merged with another of the same kind and
+# converted to and from plain JSON, so summaries of separate files (or
+# from worker processes, see --jobs) are simply combined.
+#
+# == Summary file ==
+# With --summary the combined aggregates are kept in a SQLite file,
+# together with the incremental ingest offsets (see SSSIngestState) and
+# the payload fingerprint of every record already counted (the 'seen'
+# table, as used by merge.py).  Each run only parses what has been
+# appended since the last one, and only counts records not seen before,
+# so meters re-exporting their whole memory (which forces a full
+# re-parse) are not counted twice.  All three are committed together in
+# one transaction at the end of the run.
+#
+# == Distributions ==
+# Count, minimum, maximum and mean are exact.  Quantiles come from a
+# histogram with logarithmically sized buckets, each (1+a)/(1-a) wider
+# than the last, so any quantile is within a relative error of 'a'
+# (RELATIVE_ACCURACY) of a true value.  Merging two histograms is
+# adding their bucket counts; readings of zero are counted separately.
+
+import collections
+import json
+import math
+import multiprocessing
+import optparse
+import os
+import sys
+
+import merge
+import portableappliancetest as pat
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+Dimensions = ('site', 'location', 'tester')
+
+class Distribution(object):
+    """Mergeable count/min/max/mean and approximate quantiles."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.zeros = 0
+        self.buckets = collections.defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if value > 0:
+            self.buckets[int(math.ceil(math.log(value) / LOG_GAMMA))] += 1
+        else:
+            self.zeros += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in (other.minimum, other.maximum):
+            if value is not None:
+                if self.minimum is None or value < self.minimum:
+                    self.minimum = value
+                if self.maximum is None or value > self.maximum:
+                    self.maximum = value
+        self.zeros += other.zeros
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return self.minimum
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if rank < seen:
+                value = 2 * GAMMA ** bucket / (GAMMA + 1)
+                return min(max(value, self.minimum), self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total,
+                'minimum': self.minimum, 'maximum': self.maximum,
+                'zeros': self.zeros, 'buckets': dict(self.buckets)}
+
+    @classmethod
+    def from_dict(cls, d):
+        self = cls()
+        self.count, self.total = d['count'], d['total']
+        self.minimum, self.maximum = d['minimum'], d['maximum']
+        self.zeros = d['zeros']
+        for bucket, count in d['buckets'].items():
+            self.buckets[int(bucket)] = count
+        return self
+
+class Summary(object):
+    """Mergeable aggregates for one group of records."""
+
+    def __init__(self):
+        self.records = 0
+        self.fails = 0
+        self.frequencies = collections.defaultdict(int)
+        self.retest_due = collections.defaultdict(int)
+        self.measurements = collections.defaultdict(Distribution)
+
+    def add(self, failed, frequency, due, measurements):
+        self.records += 1
+        self.fails += failed
+        if frequency is not None:
+            self.frequencies[frequency] += 1
+        if due is not None:
+            self.retest_due[due] += 1
+        for name, value in measurements:
+            self.measurements[name].add(value)
+
+    def merge(self, other):
+        self.records += other.records
+        self.fails += other.fails
+        for frequency, count in other.frequencies.items():
+            self.frequencies[frequency] += count
+        for due, count in other.retest_due.items():
+            self.retest_due[due] += count
+        for name, distribution in other.measurements.items():
+            self.measurements[name].merge(distribution)
+
+    def to_dict(self):
+        return {'records': self.records, 'fails': self.fails,
+                'frequencies': dict(self.frequencies),
+                'retest_due': dict(self.retest_due),
+                'measurements': dict([(name, d.to_dict()) for name, d in self.measurements.items()])}
+
+    @classmethod
+    def from_dict(cls, d):
+        self = cls()
+        self.records, self.fails = d['records'], d['fails']
+        for frequency, count in d['frequencies'].items():
+            self.frequencies[int(frequency)] = count
+        self.retest_due.update(d['retest_due'])
+        for name, distribution in d['measurements'].items():
+            self.measurements[name] = Distribution.from_dict(distribution)
+        return self
+
+# Sites, locations and testers are grouped by unicode values, the
+# meter's 8-bit strings decoded as Latin-1 (as for --jsonl), so they can
+# be written as JSON and match those read back from a summary.
+def group_key(value):
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    return value
+
+# Month 'months' after 'year'/'month', as 'YYYY-MM'
+def add_months(year, month, months):
+    year, month = divmod(year * 12 + month - 1 + months, 12)
+    return '%04d-%02d' % (year, month + 1)
+
+class Report(object):
+    """A Summary of every record, and one per site, location and tester."""
+
+    def __init__(self):
+        self.overall = Summary()
+        self.groups = dict([(dimension, collections.defaultdict(Summary)) for dimension in Dimensions])
+
+    def add(self, record):
+        visual = frequency = due = None
+        failed = False
+        measurements = []
+        for subrecord in record.subrecords():
+            t = subrecord.test
+            if subrecord.type_code in pat.FailTestCodes:
+                failed = True
+            if isinstance(t, pat.SSSVisualTest):
+                visual = t.data
+            elif isinstance(t, pat.SSSRetestTest):
+                frequency = t.data['frequency']
+            elif t.scaled or t.flags:
+                # Electrical tests: numbers as they are, pass flags as 0/1
+                for field, value in t.data.items():
+                    if not isinstance(value, basestring):
+                        measurements.append(('%s: %s' % (subrecord.name, field), float(value)))
+        if visual is not None and frequency:
+            due = add_months(visual['year'], visual['month'], frequency)
+
+        self.overall.add(failed, frequency, due, measurements)
+        if visual is not None:
+            for dimension in Dimensions:
+                self.groups[dimension][group_key(visual[dimension])].add(failed, frequency, due, measurements)
+
+    def add_records(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def merge(self, other):
+        self.overall.merge(other.overall)
+        for dimension in Dimensions:
+            for value, summary in other.groups[dimension].items():
+                self.groups[dimension][value].merge(summary)
+        return self
+
+    def to_dict(self):
+        return {'relative_accuracy': RELATIVE_ACCURACY,
+                'overall': self.overall.to_dict(),
+                'groups': dict([(dimension, dict([(value, s.to_dict()) for value, s in groups.items()]))
+                                for dimension, groups in self.groups.items()])}
+
+    @classmethod
+    def from_dict(cls, d):
+        assert d['relative_accuracy'] == RELATIVE_ACCURACY
+        self = cls()
+        self.overall = Summary.from_dict(d['overall'])
+        for dimension, groups in d['groups'].items():
+            for value, summary in groups.items():
+                self.groups[dimension][group_key(value)] = Summary.from_dict(summary)
+        return self
+
+class SummaryStore(object):
+    """A Report, with the ingest offsets and fingerprints of the records
+    counted in it, kept in one SQLite file and saved in one commit."""
+
+    def __init__(self, filename):
+        self.index = merge.SeenIndex(filename)
+        self.connection = self.index.connection
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+        values = dict(self.connection.execute('SELECT name, value FROM state'))
+        self.report = Report()
+        if 'report' in values:
+            self.report = Report.from_dict(json.loads(values['report']))
+        self.ingest = pat.SSSIngestState()
+        self.ingest.files = json.loads(values.get('offsets', '{}'))
+
+    # Count the records of 'filename' not seen before; returns how many
+    def add_file(self, filename):
+        key = os.path.abspath(filename)
+        previous = self.ingest.files.get(key)
+        added = 0
+        batch = []
+        try:
+            for record in self.ingest.new_records(filename, lambda start, end, error: None):
+                batch.append((pat.payload_fingerprint(record), record))
+                if len(batch) >= merge.BATCH_RECORDS:
+                    added += self._add_batch(batch)
+                    batch = []
+            added += self._add_batch(batch)
+        except Exception:
+            # Parse this file again from its old offset next time; records
+            # already counted are then recognised by their fingerprints.
+            if previous is None:
+                self.ingest.files.pop(key, None)
+            else:
+                self.ingest.files[key] = previous
+            raise
+        return added
+
+    def _add_batch(self, batch):
+        counted = []
+        try:
+            for fingerprint, record in merge.unseen(self.index, batch):
+                self.report.add(record)
+                counted.append(fingerprint)
+        finally:
+            self.index.add(counted, commit=False)
+        return len(counted)
+
+    def save(self):
+        self.connection.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                                    [('report', json.dumps(self.report.to_dict(), sort_keys=True)),
+                                     ('offsets', json.dumps(self.ingest.files, sort_keys=True))])
+        self.connection.commit()
+
+    def close(self):
+        self.index.close()
+
+# Runs in a worker process; a Report of one file, as a dictionary
+def report_file(filename):
+    try:
+        return Report().add_records(pat.open_records(filename, lambda start, end, error: None)).to_dict()
+    except Exception, e:
+        print >>sys.stderr, '%s: %s: %s' % (filename, e.__class__.__name__, e)
+        return Report().to_dict()
+
+def parallel_report(filenames, processes=None):
+    report = Report()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for d in pool.imap(report_file, filenames):
+            report.merge(Report.from_dict(d))
+    finally:
+        pool.terminate()
+    return report
+
+def print_summary(label, summary):
+    rate = 100.0 * summary.fails / summary.records if summary.records else 0.0
+    print '%-20s {records:%d, passes:%d, fails:%d, fail_rate:%.1f%%}' % \
+        (label, summary.records, summary.records - summary.fails, summary.fails, rate)
+
+def print_report(report, dimension='site'):
+    print_summary('Overall', report.overall)
+    for frequency, count in sorted(report.overall.frequencies.items()):
+        print '  Retest every %d months {records:%d}' % (frequency, count)
+    for due, count in sorted(report.overall.retest_due.items()):
+        print '  Retest due %s {records:%d}' % (due, count)
+    for name, d in sorted(report.overall.measurements.items()):
+        print '  %s {count:%d, min:%g, p50:%g, p90:%g, max:%g, mean:%g}' % \
+            (name, d.count, d.minimum, d.quantile(0.5), d.quantile(0.9), d.maximum, d.mean())
+    print
+    for value, summary in sorted(report.groups[dimension].items()):
+        print_summary('%s %r' % (dimension.capitalize(), value.encode('latin-1')), summary)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <input.sss|input.gar> ...')
+    parser.add_option('--by', choices=Dimensions, default='site',
+                      help='group the report by site, location or tester (default: %default)')
+    parser.add_option('--summary', metavar='FILE',
+                      help='keep the aggregates in FILE, adding only records not counted before')
+    parser.add_option('-j', '--jobs', type='int', default=None, metavar='N',
+                      help='number of worker processes without --summary (default: one per CPU)')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print the aggregates as JSON instead')
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+    filenames = list(pat.find_inputs(args))
+
+    if options.summary:
+        store = SummaryStore(options.summary)
+        for filename in filenames:
+            try:
+                store.add_file(filename)
+            except Exception, e:
+                print >>sys.stderr, '%s: %s: %s' % (filename, e.__class__.__name__, e)
+        store.save()
+        store.close()
+        report = store.report
+    else:
+        report = parallel_report(filenames, options.jobs)
+
+    if options.json:
+        json.dump(report.to_dict(), sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        print_report(report, options.by)
+
+if __name__=='__main__':
+    main()
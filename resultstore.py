@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Seaward SSS PAT testing results, loaded into a local SQLite database
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: resultstore.py load results.db <input1.sss|input1.gar> ...
+#          resultstore.py history results.db <asset id>
+#          resultstore.py fails results.db <site> [from-date [to-date]]
+#
+# Once loaded, questions such as "the full history of asset X" or "all
+# fails at site Y last quarter" are indexed queries, rather than needing
+# every '.sss' file to be parsed again.
+#
+# == Tables ==
+# records: one row per record; the source file and offset, the header
+#   fields, checksums, detected version and the overall fail flag.
+# visual: the visual test sub-record of each record (asset id, date and
+#   time as 'YYYY-MM-DD HH:MM', site, location, tester and testcodes).
+# measurements: one row per field of every other sub-record, keyed by
+#   its type code; numbers (and pass flags as 0/1) are held in 'value',
+#   strings (and "(no result)") in 'text'.
+#
+# Strings are stored as the meter's 8-bit bytes, undecoded (site names
+# and the like are often Latin-1), and come back from queries as 'str';
+# a site given on the command line must match those bytes exactly.
+#
+# Loading a file again replaces the rows previously loaded from it, or
+# if it fails to load, leaves them as they were.
+
+import optparse
+import os
+import sqlite3
+import sys
+
+import portableappliancetest as pat
+
+# Rows are written with executemany() this many records at a time
+BATCH_RECORDS = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    record_id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    payload_length INTEGER,
+    nulls INTEGER,
+    checksum_header INTEGER,
+    checksum_payload INTEGER,
+    checksum_match INTEGER,
+    version INTEGER,
+    failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS visual (
+    record_id INTEGER PRIMARY KEY REFERENCES records(record_id),
+    type_code INTEGER,
+    id TEXT,
+    datetime TEXT,
+    site TEXT,
+    location TEXT,
+    tester TEXT,
+    testcode1 TEXT,
+    testcode2 TEXT
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    record_id INTEGER REFERENCES records(record_id),
+    position INTEGER,
+    type_code INTEGER,
+    name TEXT,
+    field TEXT,
+    value REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS records_source ON records(source);
+CREATE INDEX IF NOT EXISTS visual_id ON visual(id);
+CREATE INDEX IF NOT EXISTS visual_site_datetime ON visual(site, datetime);
+CREATE INDEX IF NOT EXISTS visual_datetime ON visual(datetime);
+CREATE INDEX IF NOT EXISTS measurements_record ON measurements(record_id);
+CREATE INDEX IF NOT EXISTS measurements_type_code ON measurements(type_code);
+'''
+
+def connect(database_filename):
+    connection = sqlite3.connect(database_filename)
+    connection.text_factory = str
+    connection.executescript(SCHEMA)
+    return connection
+
+# Remove everything previously loaded from 'source'
+def forget_source(connection, source):
+    where = 'record_id IN (SELECT record_id FROM records WHERE source = ?)'
+    connection.execute('DELETE FROM measurements WHERE ' + where, (source,))
+    connection.execute('DELETE FROM visual WHERE ' + where, (source,))
+    connection.execute('DELETE FROM records WHERE source = ?', (source,))
+
+def flush(connection, records, visuals, measurements):
+    connection.executemany('INSERT INTO records VALUES (?,?,?,?,?,?,?,?,?,?)', records)
+    connection.executemany('INSERT INTO visual VALUES (?,?,?,?,?,?,?,?,?)', visuals)
+    connection.executemany('INSERT INTO measurements VALUES (?,?,?,?,?,?,?)', measurements)
+    del records[:], visuals[:], measurements[:]
+
+# Load every record of an '.sss' or '.gar' file, returning the number
+# of records loaded and the number of corrupt byte ranges skipped.
+# Removing the file's old rows and inserting the new ones is a single
+# transaction, committed once the whole file has loaded; if loading
+# fails, the caller's rollback() leaves the previous load untouched.
+def load_file(connection, filename):
+    source = os.path.abspath(filename)
+    forget_source(connection, source)
+    record_id = connection.execute('SELECT COALESCE(MAX(record_id), 0) FROM records').fetchone()[0]
+
+    skipped = []
+    records, visuals, measurements = [], [], []
+    count = 0
+    for record in pat.open_records(filename, lambda start, end, error: skipped.append(error)):
+        record_id += 1
+        count += 1
+        failed = False
+        for position, subrecord in enumerate(record.subrecords()):
+            t = subrecord.test
+            if subrecord.type_code in pat.FailTestCodes:
+                failed = True
+            if isinstance(t, pat.SSSVisualTest):
+                d = t.data
+                visuals.append((record_id, subrecord.type_code, d['id'],
+                                '%04d-%02d-%02d %02d:%02d' % (d['year'], d['month'], d['day'], d['hour'], d['minute']),
+                                d['site'], d['location'], d['tester'], d['testcode1'], d['testcode2']))
+                continue
+            for field, value in t.data.items():
+                if isinstance(value, basestring):
+                    measurements.append((record_id, position, subrecord.type_code, subrecord.name, field, None, value))
+                else:
+                    measurements.append((record_id, position, subrecord.type_code, subrecord.name, field, value, None))
+        h = record.header.data
+        records.append((record_id, source, record.offset, h['payload_length'], h['nulls'],
+                        h['checksum_header'], h['checksum_payload'], h['checksum_match'],
+                        record.version, failed))
+        if len(records) >= BATCH_RECORDS:
+            flush(connection, records, visuals, measurements)
+    flush(connection, records, visuals, measurements)
+    connection.commit()
+    return count, len(skipped)
+
+# == Queries ==
+def asset_history(connection, asset_id):
+    return connection.execute('''
+        SELECT v.datetime, v.site, v.location, v.tester, r.failed, r.source
+        FROM visual v JOIN records r USING (record_id)
+        WHERE v.id = ? ORDER BY v.datetime''', (asset_id,)).fetchall()
+
+# Dates are compared as text, so 'YYYY-MM-DD' bounds work as expected;
+# 'until' is exclusive.
+def site_fails(connection, site, since='0000', until='9999'):
+    return connection.execute('''
+        SELECT v.datetime, v.id, v.location, v.tester, r.source
+        FROM visual v JOIN records r USING (record_id)
+        WHERE v.site = ? AND v.datetime >= ? AND v.datetime < ? AND r.failed
+        ORDER BY v.datetime''', (site, since, until)).fetchall()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog load <database> <input.sss|input.gar> ...\n'
+                                         '       %prog history <database> <asset id>\n'
+                                         '       %prog fails <database> <site> [from-date [to-date]]')
+    options, args = parser.parse_args()
+    if len(args) < 3 or args[0] not in ('load', 'history', 'fails'):
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+    command, connection = args[0], connect(args[1])
+
+    if command == 'load':
+        for filename in args[2:]:
+            print 'Loading "%s"' % filename
+            try:
+                count, skipped = load_file(connection, filename)
+            except Exception, e:
+                connection.rollback()
+                print 'End File {Error:"%s: %s"}' % (e.__class__.__name__, e)
+                continue
+            print 'Loaded {records:%d, skipped:%d}' % (count, skipped)
+    elif command == 'history':
+        for row in asset_history(connection, args[2]):
+            print '%s  %-16s %-16s %-11s %s  %s' % (row[0], row[1], row[2], row[3],
+                                                   'FAIL' if row[4] else 'pass', row[5])
+    else:
+        for row in site_fails(connection, *args[2:5]):
+            print '%s  %-16s %-16s %-11s %s' % row
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Tests for gar.py
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: python -m unittest test_gar
+#
+# The bulk keystream, SWAR add/subtract and jump-ahead are checked
+# against the original per-byte generator, deobfuscate_string(); and
+# containers built with gar_write() are read back with gar_extract()
+# and gar_read_member().
+
+import StringIO
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import gar
+
+Seeds = [(), (0x12345678, 1500), (0xffffffff, 0), (1, 0xffffffff, 7, 0)]
+
+# Lengths either side of the parallel chunk size used below
+CHUNK_SIZE = 1000
+Lengths = [0, 1, 2, 7, 8, 9, 255, 999, 1000, 1001, 2047, 2 * CHUNK_SIZE + 3]
+
+def random_bytes(rng, length):
+    return ''.join([chr(rng.getrandbits(8)) for i in xrange(length)])
+
+class KeystreamTest(unittest.TestCase):
+    def test_keystream_matches_generator(self):
+        for seed in Seeds:
+            pnr = gar.marsaglia_xorshift_128(*seed)
+            expected = bytearray([pnr.next() & 0xff for i in xrange(5000)])
+            self.assertEqual(gar.XorshiftKeystream(*seed).keystream(5000), expected)
+
+    def test_split_keystream(self):
+        for seed in Seeds:
+            whole = gar.XorshiftKeystream(*seed).keystream(3000)
+            ks = gar.XorshiftKeystream(*seed)
+            parts = ks.keystream(0) + ks.keystream(1) + ks.keystream(999) + ks.keystream(2000)
+            self.assertEqual(parts, whole)
+
+    def test_jump_matches_stepping(self):
+        for seed in Seeds:
+            for steps in (0, 1, 2, 63, 64, 1000, 12345):
+                ks = gar.XorshiftKeystream(*seed)
+                ks.keystream(steps)
+                self.assertEqual(gar.xorshift_jump(gar.XorshiftKeystream(*seed).state, steps), ks.state)
+                self.assertEqual(gar.XorshiftKeystream(*seed).jump(steps).state, ks.state)
+
+class DeobfuscateTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def check(self, operation, length, seed=(0x12345678, 1500)):
+        data = random_bytes(self.rng, length)
+        expected = gar.deobfuscate_string(gar.marsaglia_xorshift_128(*seed), data, operation)
+        result = gar.deobfuscate_bytes(gar.XorshiftKeystream(*seed), data, operation)
+        self.assertEqual(result, expected)
+
+    def test_subtract(self):
+        for length in Lengths:
+            self.check(int.__sub__, length)
+
+    def test_add(self):
+        for length in Lengths:
+            self.check(int.__add__, length)
+
+    def test_generic_operation(self):
+        for length in Lengths:
+            self.check(int.__xor__, length)
+
+    def test_edge_bytes(self):
+        # All-0x00 and all-0xff, where carries and borrows would spill over
+        for operation in (int.__sub__, int.__add__):
+            for fill in ('\x00', '\xff', '\x80', '\x7f'):
+                seed = (0x12345678, 1500)
+                data = fill * 1001
+                expected = gar.deobfuscate_string(gar.marsaglia_xorshift_128(*seed), data, operation)
+                self.assertEqual(gar.deobfuscate_bytes(gar.XorshiftKeystream(*seed), data, operation), expected)
+
+    def test_split_calls(self):
+        data = random_bytes(self.rng, 5000)
+        seed = (0xdeadbeef, 5000)
+        expected = gar.deobfuscate_string(gar.marsaglia_xorshift_128(*seed), data)
+        ks = gar.XorshiftKeystream(*seed)
+        parts, offset = [], 0
+        for length in (0, 1, 4, 995, 1000, 3000):
+            parts.append(gar.deobfuscate_bytes(ks, data[offset:offset + length]))
+            offset += length
+        self.assertEqual(''.join(parts), expected)
+
+    def test_add_inverts_subtract(self):
+        data = random_bytes(self.rng, 3001)
+        obfuscated = gar.deobfuscate_bytes(gar.XorshiftKeystream(1, 2), data, int.__add__)
+        self.assertEqual(gar.deobfuscate_bytes(gar.XorshiftKeystream(1, 2), obfuscated), data)
+
+class ParallelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+
+    def test_parallel_matches_serial(self):
+        rng = random.Random(2)
+        for length in Lengths:
+            data = random_bytes(rng, length)
+            seed = (length, 0x5555)
+            expected = gar.deobfuscate_string(gar.marsaglia_xorshift_128(*seed), data)
+            ks = gar.XorshiftKeystream(*seed)
+            chunks = list(gar.deobfuscate_parallel(self.pool, ks, data, CHUNK_SIZE))
+            self.assertEqual(''.join(chunks), expected)
+            # The keystream is left as if it had been used serially
+            serial = gar.XorshiftKeystream(*seed)
+            serial.keystream(length)
+            self.assertEqual(ks.state, serial.state)
+
+class WriterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        rng = random.Random(3)
+        # An empty member, compressible results and a (random, so
+        # incompressible) photo large enough to be deobfuscated in parallel
+        self.members = [('Empty.txt', ''),
+                        ('TestResults.sss', 'results ' * 20000),
+                        ('Photo_1.jpg', random_bytes(rng, 2 * gar.PARALLEL_CHUNK_SIZE + 1001))]
+        self.filenames = []
+        for name, contents in self.members:
+            filename = os.path.join(self.directory, 'in', name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.mkdir(os.path.dirname(filename))
+            f = open(filename, 'wb')
+            f.write(contents)
+            f.close()
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write(self, pool):
+        container_filename = os.path.join(self.directory, 'out.gar')
+        names = gar.gar_create(container_filename, self.filenames, pool, start=1000)
+        self.assertEqual(names, [name for name, contents in self.members])
+        return container_filename
+
+    def check_round_trip(self, container_filename, pool):
+        members = gar.gar_index(gar.gar_open(container_filename))
+        self.assertEqual([m.filename for m in members], [name for name, contents in self.members])
+        self.assertEqual([m.truncated_timestamp for m in members], [1000, 1001, 1002])
+
+        for name, contents in self.members:
+            self.assertEqual(gar.gar_read_member(container_filename, name, pool), contents)
+
+        # gar_extract() saves into the current directory
+        os.chdir(self.directory)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            gar.gar_extract(container_filename, pool)
+        finally:
+            sys.stdout = stdout
+        for name, contents in self.members:
+            if name == 'TestResults.sss':
+                name = gar.clean_filename(container_filename[:-4] + '_' + name)
+            f = open(os.path.join(self.directory, name), 'rb')
+            self.assertEqual(f.read(), contents)
+            f.close()
+        self.assertEqual(gar.gar_verify(container_filename, self.filenames), len(self.members))
+
+    def test_serial(self):
+        self.check_round_trip(self.write(None), None)
+
+    def test_pool(self):
+        self.check_round_trip(self.write(self.pool), self.pool)
+
+    def test_pool_matches_serial(self):
+        serial = open(self.write(None), 'rb').read()
+        self.assertEqual(open(self.write(self.pool), 'rb').read(), serial)
+
+    def test_verify_detects_changes(self):
+        container_filename = self.write(None)
+        f = open(self.filenames[1], 'ab')
+        f.write('x')
+        f.close()
+        self.assertRaises(ValueError, gar.gar_verify, container_filename, self.filenames)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Tests for report.py
+# Hereby placed in the public domain in the hopes of improving
+# electrical safety and interoperability.
+#
+# Example: python -m unittest test_report
+#
+# Reports of records built with corpus.py, with an 8-bit (Latin-1) site
+# name as sent by the meter, are saved to and loaded from JSON and a
+# summary file, and merged with fresh ones.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import corpus
+import portableappliancetest as pat
+import report
+
+SITE = 'Caf\xe9'
+
+# A passed record with only a visual test, at 'site'
+def visual_record(site, asset='A0000001'):
+    values = [asset, 12, 30, 1, 6, 2012, site, 'Kitchen', 'Tester', '0' * 9, '0' * 10]
+    payload = corpus.pack_subrecord(0x01, pat.SSSVisualTest, values) + chr(0xf0) + chr(0xff)
+    return corpus.sss_record(payload)
+
+class GroupKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'input.sss')
+        f = open(self.filename, 'wb')
+        f.write(visual_record(SITE) + visual_record('Office', 'A0000002'))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def report(self):
+        return report.Report().add_records(pat.open_records(self.filename))
+
+    def test_json_round_trip(self):
+        d = json.loads(json.dumps(self.report().to_dict(), sort_keys=True))
+        loaded = report.Report.from_dict(d)
+        self.assertEqual(loaded.groups['site'][u'Caf\xe9'].records, 1)
+
+    def test_merge_with_loaded(self):
+        d = json.loads(json.dumps(self.report().to_dict()))
+        merged = report.Report.from_dict(d).merge(self.report())
+        self.assertEqual(sorted(merged.groups['site']), [u'Caf\xe9', u'Office'])
+        self.assertEqual(merged.groups['site'][u'Caf\xe9'].records, 2)
+
+    def test_summary_store(self):
+        summary = os.path.join(self.directory, 'summary.db')
+        store = report.SummaryStore(summary)
+        self.assertEqual(store.add_file(self.filename), 2)
+        store.save()
+        store.close()
+
+        # Appended records are counted into the groups read back
+        f = open(self.filename, 'ab')
+        f.write(visual_record(SITE, 'A0000003'))
+        f.close()
+        store = report.SummaryStore(summary)
+        self.assertEqual(store.add_file(self.filename), 1)
+        store.save()
+        store.close()
+        self.assertEqual(store.report.groups['site'][u'Caf\xe9'].records, 2)
+        self.assertEqual(store.report.overall.records, 3)
+
+if __name__ == '__main__':
+    unittest.main()